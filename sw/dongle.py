@@ -55,9 +55,39 @@ import sys
 import string
 import time
 import struct
+import array
+import threading
+import Queue
+import mmap
+import zlib
+import cStringIO
+import collections
+import json
+import random
+try:
+    import ctypes   # to receive straight into mapped output files
+except ImportError:
+    ctypes = None
+try:
+    import lzma     # xz images, on Python 2 from backports.lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard    # zstd images
+except ImportError:
+    zstandard = None
 from sets import *
 from struct import *
 
+# with "-" for the file the image goes through stdin or stdout and the
+# messages are printed to stderr
+data_out = sys.stdout
+if __name__=='__main__' and '-' in sys.argv[1:]:
+    sys.stdout = sys.stderr
+
 #### inline of artec FTDI specific Uspp code ###################################################
 
 ##########################################################################
@@ -137,12 +167,16 @@ elif sys.platform=='linux2':
     import fcntl
     import exceptions
     import array
+    import io
+    import select
     print "Linux platform detected:"
 elif sys.platform=='darwin':
     from termios import *
     import fcntl
     import exceptions
     import array
+    import io
+    import select
     print "Mac OS X platform detected:"
 else:
     sys.exit('Sorry, no implementation for this platform yet')
@@ -156,9 +190,71 @@ class SerialPortException(exceptions.Exception):
     def __str__(self):
         return repr(self.args)
 
+
+# Monotonic clock for timeouts and deadlines, time.time() jumps with the wall
+# clock and time.clock() is CPU time on unix
+if sys.platform=='win32':
+    monotonic_time = time.clock   # QueryPerformanceCounter based on windows
+else:
+    try:
+        import ctypes
+        import ctypes.util
+
+        class _timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        _libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+        _clock_gettime = _libc.clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        if sys.platform=='darwin':
+            _CLOCK_MONOTONIC = 6
+        else:
+            _CLOCK_MONOTONIC = 1
+
+        def monotonic_time():
+            """Seconds from an arbitrary fixed point, never goes backwards"""
+            t = _timespec()
+            if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                return time.time()
+            return t.tv_sec + t.tv_nsec * 1e-9
+        monotonic_time()
+    except (ImportError, OSError, AttributeError):
+        monotonic_time = time.time
+
+
+class DongleTransport:
+    """Byte stream link the Dongle class talks to. The serial port classes and
+    DongleEmulator implement it: write(s), read(num), readview(num),
+    readinto(view), inWaiting(), outWaiting(), waitInput(byteCount, timeout)
+    and flush().
+    now() and sleep() are the clock of the link, the emulator runs on simulated
+    time so everything pacing the link must use them"""
+
+    def readview(self, num):
+        return self.read(num)
+
+    def readinto(self, view):
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def now(self):
+        return monotonic_time()
+
+    def sleep(self, seconds):
+        deadline = monotonic_time() + seconds
+        if sys.platform=='win32':
+            # windows sleeps in whole timer ticks, finish short waits on the clock
+            if seconds > 0.002:
+                time.sleep(seconds - 0.002)
+            while monotonic_time() < deadline:
+                pass
+        elif seconds > 0:
+            time.sleep(seconds)
+
     
 if sys.platform=='win32':    
-  class SerialPortWin:
+  class SerialPortWin(DongleTransport):
     BaudRatesDic={110: CBR_110,
                   300: CBR_300,
                   600: CBR_600,
@@ -192,9 +288,7 @@ if sys.platform=='win32':
                 break
                         
             except:
-                n=0
-                while (n < 2000000):
-                    n += 1;                
+                LinkPacer.open_retry_wait()
                 self.__reopen = self.__reopen + 1
             if self.__reopen > 32:
                 print "Port does not exist... retries exhausted..."
@@ -281,6 +375,23 @@ if sys.platform=='win32':
         flags, comstat = ClearCommError(self.__handle)
         return comstat.cbInQue
 
+    def outWaiting(self):
+        """Returns the number of bytes waiting to be written"""
+        flags, comstat = ClearCommError(self.__handle)
+        return comstat.cbOutQue
+
+    def waitInput(self, byteCount, timeout=None):
+        """Wait until byteCount bytes are waiting or timeout seconds have passed
+        returns the number of bytes waiting"""
+        if timeout==None:
+            timeout = (self.__timeout or 0)/1000.0
+        deadline = monotonic_time() + timeout
+        waiting = self.inWaiting()
+        while waiting < byteCount and monotonic_time() < deadline:
+            time.sleep(0.001)   # no readiness wait for comm handles, 1ms is the timer resolution
+            waiting = self.inWaiting()
+        return waiting
+
     def flush(self):
         """Discards all bytes from the output or input buffer"""
         PurgeComm(self.__handle, PURGE_TXABORT|PURGE_RXABORT|PURGE_TXCLEAR|
@@ -289,7 +400,7 @@ if sys.platform=='win32':
 
                   
 if sys.platform=='linux2':
-  class SerialPortLin:
+  class SerialPortLin(DongleTransport):
     """Encapsulate methods for accesing to a serial port."""
 
     BaudRatesDic={
@@ -306,7 +417,6 @@ if sys.platform=='linux2':
         115200: B115200,
         230400: B230400
         }
-    buf = array.array('h', '\000'*4)
 
     def __init__(self, dev, timeout=None, speed=115200, mode='232', params=None):
         self.__devName, self.__timeout, self.__speed=dev, timeout, speed
@@ -320,9 +430,7 @@ if sys.platform=='linux2':
                 break
                         
             except:
-                n=0
-                while (n < 2000000):
-                    n += 1;                
+                LinkPacer.open_retry_wait()
                 self.__reopen = self.__reopen + 1
             if self.__reopen > 32:
                 print "Port does not exist..."
@@ -330,6 +438,12 @@ if sys.platform=='linux2':
                 break
 
         self.__configure()
+        # reusable receive buffer, large enough for one 64K word block read
+        self.__rxbuf = bytearray(65536*2)
+        self.__rxview = memoryview(self.__rxbuf)
+        self.__rxfile = io.FileIO(self.__handle, 'r', closefd=False)
+        self.__poll = select.poll()
+        self.__poll.register(self.__handle, select.POLLIN|select.POLLPRI)
 
     def __del__(self):
 	if self.__speed:
@@ -388,14 +502,48 @@ if sys.platform=='linux2':
         return self.__handle
 
 
+    def __deadline(self, timeout=None):
+        """Monotonic deadline for a wait, port timeout is in milliseconds"""
+        if timeout==None:
+            if self.__timeout==None:
+                return None     # blocking port
+            timeout = self.__timeout/1000.0
+        return monotonic_time() + timeout
+
+    def __waitReadable(self, deadline):
+        """Sleep until the port has data or the deadline passes, returns 1 if readable"""
+        while 1:
+            if deadline==None:
+                left = None
+            else:
+                left = max(deadline - monotonic_time(), 0.0)
+            if left==None:
+                ready = self.__poll.poll()
+            else:
+                ready = self.__poll.poll(int(left*1000.0 + 0.999))
+            if ready:
+                return 1
+            if left==0.0:
+                return 0
+
+    def waitInput(self, byteCount, timeout=None):
+        """Wait until byteCount bytes are waiting or timeout seconds have passed
+        returns the number of bytes waiting"""
+        deadline = self.__deadline(timeout)
+        waiting = self.inWaiting()
+        while waiting < byteCount:
+            if not self.__waitReadable(deadline):
+                break
+            waiting = self.inWaiting()
+            if waiting < byteCount:
+                time.sleep(0.0002)  # rest of the reply is still on the way
+        return waiting
+
     def __read1(self):
-        tryCnt = 0
         byte = ""
-        while(len(byte)==0 and tryCnt<10):
-            tryCnt+=1
+        if self.__waitReadable(self.__deadline()):
             byte = os.read(self.__handle, 2)
         if len(byte)==0 and self.__timeout!=0: # Time-out
-            print 'Time out cnt was %i'%(tryCnt) 
             print 'Expected 1 byte but got %i before timeout'%(len(byte))
             sys.stdout.flush()
             raise SerialPortException('Timeout')
@@ -403,11 +551,38 @@ if sys.platform=='linux2':
             return byte
             
 
+    def readinto(self, view):
+        """Fill the writable buffer view from the port with as few reads as possible
+        returns the number of bytes received"""
+        num = len(view)
+        got = 0
+        while got < num:
+            # timeout counts from the last received data
+            if not self.__waitReadable(self.__deadline()):
+                if self.__timeout!=0: # Time-out
+                    print 'Expected %i bytes but got %i before timeout'%(num,got)
+                    sys.stdout.flush()
+                    raise SerialPortException('Timeout')
+                break
+            n = self.__rxfile.readinto(view[got:])
+            if not n:   # readable but nothing to read means the device went away
+                raise SerialPortException('Port closed')
+            got += n
+        return got
+
+
+    def readview(self, num):
+        """Read num bytes into the reusable receive buffer and return a memoryview
+        of them. The view is only valid until the next read from the port"""
+        if num > len(self.__rxbuf):
+            self.__rxbuf = bytearray(num)
+            self.__rxview = memoryview(self.__rxbuf)
+        got = self.readinto(self.__rxview[:num])
+        return self.__rxview[:got]
+
+
     def read(self, num=1):
-        s=''
-        for i in range(num/2):
-            s=s+SerialPortLin.__read1(self)
-        return s
+        return self.readview(num).tobytes()
 
 
     def readline(self):
@@ -432,10 +607,10 @@ if sys.platform=='linux2':
     def outWaiting(self):
         """Returns the number of bytes waiting to be write
         mod. by J.Grauheding
-        result needs some finetunning
         """
-        rbuf=fcntl.ioctl(self.__handle, TIOCOUTQ, self.buf)
-        return rbuf
+        data = struct.pack("L", 0)
+        data=fcntl.ioctl(self.__handle, TIOCOUTQ, data)
+        return struct.unpack("L", data)[0]
 
     
     def flush(self):
@@ -444,7 +619,7 @@ if sys.platform=='linux2':
 
 
 if sys.platform=='darwin':
-  class SerialPortOSX:
+  class SerialPortOSX(DongleTransport):
     """Encapsulate methods for accesing to a serial port."""
 
     BaudRatesDic={
@@ -461,7 +636,6 @@ if sys.platform=='darwin':
         115200: B115200,
         230400: B230400
         }
-    buf = array.array('h', '\000'*4)
 
     def __init__(self, dev, timeout=None, speed=115200, mode='232', params=None):
         self.__devName, self.__timeout, self.__speed=dev, timeout, speed
@@ -475,9 +649,7 @@ if sys.platform=='darwin':
                 break
                         
             except:
-                n=0
-                while (n < 2000000):
-                    n += 1;                
+                LinkPacer.open_retry_wait()
                 self.__reopen = self.__reopen + 1
             if self.__reopen > 32:
                 print "Port does not exist..."
@@ -485,6 +657,10 @@ if sys.platform=='darwin':
                 break
 
         self.__configure()
+        # reusable receive buffer, large enough for one 64K word block read
+        self.__rxbuf = bytearray(65536*2)
+        self.__rxview = memoryview(self.__rxbuf)
+        self.__rxfile = io.FileIO(self.__handle, 'r', closefd=False)
 
     def __del__(self):
 	if self.__speed:
@@ -543,14 +719,46 @@ if sys.platform=='darwin':
         return self.__handle
 
 
+    def __deadline(self, timeout=None):
+        """Monotonic deadline for a wait, port timeout is in milliseconds"""
+        if timeout==None:
+            if self.__timeout==None:
+                return None     # blocking port
+            timeout = self.__timeout/1000.0
+        return monotonic_time() + timeout
+
+    def __waitReadable(self, deadline):
+        """Sleep until the port has data or the deadline passes, returns 1 if readable"""
+        while 1:
+            if deadline==None:
+                left = None
+            else:
+                left = max(deadline - monotonic_time(), 0.0)
+            # poll() does not work on ttys on Mac OS X
+            ready = select.select([self.__handle], [], [], left)[0]
+            if ready:
+                return 1
+            if left==0.0:
+                return 0
+
+    def waitInput(self, byteCount, timeout=None):
+        """Wait until byteCount bytes are waiting or timeout seconds have passed
+        returns the number of bytes waiting"""
+        deadline = self.__deadline(timeout)
+        waiting = self.inWaiting()
+        while waiting < byteCount:
+            if not self.__waitReadable(deadline):
+                break
+            waiting = self.inWaiting()
+            if waiting < byteCount:
+                time.sleep(0.0002)  # rest of the reply is still on the way
+        return waiting
+
     def __read1(self):
-        tryCnt = 0
         byte = ""
-        while(len(byte)==0 and tryCnt<10):
-            tryCnt+=1
+        if self.__waitReadable(self.__deadline()):
             byte = os.read(self.__handle, 2)
         if len(byte)==0 and self.__timeout!=0: # Time-out
-            print 'Time out cnt was %i'%(tryCnt) 
             print 'Expected 1 byte but got %i before timeout'%(len(byte))
             sys.stdout.flush()
             raise SerialPortException('Timeout')
@@ -558,11 +766,38 @@ if sys.platform=='darwin':
             return byte
             
 
+    def readinto(self, view):
+        """Fill the writable buffer view from the port with as few reads as possible
+        returns the number of bytes received"""
+        num = len(view)
+        got = 0
+        while got < num:
+            # timeout counts from the last received data
+            if not self.__waitReadable(self.__deadline()):
+                if self.__timeout!=0: # Time-out
+                    print 'Expected %i bytes but got %i before timeout'%(num,got)
+                    sys.stdout.flush()
+                    raise SerialPortException('Timeout')
+                break
+            n = self.__rxfile.readinto(view[got:])
+            if not n:   # readable but nothing to read means the device went away
+                raise SerialPortException('Port closed')
+            got += n
+        return got
+
+
+    def readview(self, num):
+        """Read num bytes into the reusable receive buffer and return a memoryview
+        of them. The view is only valid until the next read from the port"""
+        if num > len(self.__rxbuf):
+            self.__rxbuf = bytearray(num)
+            self.__rxview = memoryview(self.__rxbuf)
+        got = self.readinto(self.__rxview[:num])
+        return self.__rxview[:got]
+
+
     def read(self, num=1):
-        s=''
-        for i in range(num/2):
-            s=s+SerialPortOSX.__read1(self)
-        return s
+        return self.readview(num).tobytes()
 
 
     def readline(self):
@@ -587,10 +822,10 @@ if sys.platform=='darwin':
     def outWaiting(self):
         """Returns the number of bytes waiting to be write
         mod. by J.Grauheding
-        result needs some finetunning
         """
-        rbuf=fcntl.ioctl(self.__handle, FIONWRITE, self.buf)
-        return rbuf
+        data = struct.pack("L", 0)
+        data=fcntl.ioctl(self.__handle, FIONWRITE, data)
+        return struct.unpack("L", data)[0]
 
     
     def flush(self):
@@ -602,6 +837,471 @@ if sys.platform=='darwin':
 #### end inline of artec FTDI specific Uspp code ###############################################
 
 
+#### in-process dongle emulator ################################################################
+
+
+class EmulatedFlash:
+    """Intel StrataFlash E28F128 in 16 bit mode as seen through the dongle:
+    read array/status/query modes, block erase, buffered program, block lock
+    bits and the status register. Memory is kept in dongle readback byte order
+    (LSB of each word first)"""
+
+    block_words = 65536
+
+    def __init__(self, size, erase_time, program_time):
+        self.size = size
+        self.mem = bytearray('\xff'*size)
+        self.erase_time = erase_time
+        self.program_time = program_time
+        self.locks = [0]*(size/(self.block_words*2))
+        self.mode = 'array'
+        self.pending = None
+        self.sr = 0x80
+        self.busy_until = 0.0
+        self.buf_left = 0
+        self.buf_words = []
+        self.overruns = 0       # commands lost because the flash was busy
+        self.erases = 0
+        self.programs = 0
+
+    def status(self, t):
+        if t < self.busy_until:
+            return self.sr & 0x7F
+        return self.sr | 0x80
+
+    def __query_word(self, addr):
+        word = addr & (self.block_words - 1)
+        table = {0x00: 0x0089, 0x01: 0x0018, 0x10: 0x0051, 0x11: 0x0052, 0x12: 0x0059,
+                 0x13: 0x0001, 0x15: 0x0031, 0x27: 0x0018, 0x2A: 0x0005}
+        if word == 0x02:
+            return self.locks[self.__block(addr)]
+        return table.get(word, 0)
+
+    def __block(self, addr):
+        return (addr % (self.size/2)) / self.block_words
+
+    def read(self, addr, count, t):
+        """Read count words from word address addr, returns LSB first byte string"""
+        if t < self.busy_until or self.mode == 'status':
+            return pack('<H', self.status(t))*count
+        if self.mode == 'array':
+            a = (addr*2) % self.size
+            if a + count*2 <= self.size:
+                return str(self.mem[a:a+count*2])
+            return str(self.mem[a:] + self.mem[:count*2 - (self.size - a)])
+        s = []
+        for i in range(count):
+            s.append(pack('<H', self.__query_word(addr+i)))
+        return "".join(s)
+
+    def __program(self, addr, data):
+        a = (addr*2) % self.size
+        if a + len(data) > self.size:   # address wraps around the window
+            split = self.size - a
+            self.__program(addr, data[:split])
+            self.__program(0, data[split:])
+            return
+        old = self.mem[a:a+len(data)]
+        if old == bytearray('\xff'*len(old)):
+            self.mem[a:a+len(data)] = data
+        else:
+            for i in range(len(old)):
+                self.mem[a+i] = old[i] & data[i]   # programming only clears bits
+
+    def load_buffer(self, addr, data):
+        """Words written to the flash during buffered program, data is in
+        USB order (MSB first)"""
+        if self.pending != 'data':
+            return              # the E8 was lost, so is its data
+        words = len(data)/2
+        swapped = bytearray(len(data))
+        swapped[0::2] = data[1::2]
+        swapped[1::2] = data[0::2]
+        self.buf_words.append((addr, swapped))
+        self.buf_left -= words
+        if self.buf_left <= 0:
+            self.pending = 'confirm'
+
+    def command(self, addr, word, t):
+        """Bus write cycle to the flash at word address addr"""
+        code = word & 0xFF
+        if t < self.busy_until:
+            if code not in (0x70, 0xB0, 0xD0) or self.pending:
+                self.overruns += 1
+            self.mode = 'status'
+            return
+        pending = self.pending
+        self.pending = None
+        if pending == 'count':
+            self.buf_left = code + 1
+            self.buf_words = []
+            self.pending = 'data'
+        elif pending == 'data':
+            self.load_buffer(addr, pack('>H', word))
+        elif pending == 'confirm':
+            if code == 0xD0:
+                block = self.__block(addr)
+                if self.locks[block]:
+                    self.sr |= 0x12
+                else:
+                    for (a, data) in self.buf_words:
+                        self.__program(a, data)
+                    self.programs += 1
+                    self.busy_until = t + self.program_time
+            else:
+                self.sr |= 0x30     # command sequence error
+            self.buf_words = []
+            self.mode = 'status'
+        elif pending == 'erase':
+            if code == 0xD0:
+                block = self.__block(addr)
+                if self.locks[block]:
+                    self.sr |= 0x22
+                else:
+                    a = block*self.block_words*2
+                    self.mem[a:a+self.block_words*2] = '\xff'*(self.block_words*2)
+                    self.erases += 1
+                    self.busy_until = t + self.erase_time
+            else:
+                self.sr |= 0x30
+            self.mode = 'status'
+        elif pending == 'lock':
+            if code == 0xD0:
+                self.locks = [0]*len(self.locks)
+                self.busy_until = t + self.program_time
+            elif code == 0x01:
+                self.locks[self.__block(addr)] = 1
+                self.busy_until = t + self.program_time
+            else:
+                self.sr |= 0x30
+            self.mode = 'status'
+        elif pending == 'word':
+            self.__program(addr, bytearray(pack('<H', word)))
+            self.programs += 1
+            self.busy_until = t + self.program_time
+            self.mode = 'status'
+        elif code == 0xFF:
+            self.mode = 'array'
+        elif code == 0x70:
+            self.mode = 'status'
+        elif code == 0x50:
+            self.sr = 0x80
+        elif code in (0x90, 0x98):
+            self.mode = 'query'
+        elif code == 0x20:
+            self.pending = 'erase'
+        elif code == 0x60:
+            self.pending = 'lock'
+        elif code in (0x40, 0x10):
+            self.pending = 'word'
+        elif code == 0xE8:
+            self.pending = 'count'
+            self.mode = 'status'    # XSR is read after E8, buffer is always available
+        elif code in (0xB0, 0xD0):
+            pass                    # suspend/resume, nothing is ever in progress long enough
+        else:
+            self.sr |= 0x30
+
+
+class DongleEmulator(DongleTransport):
+    """In-process dongle speaking the usb2mem command set, so dongle.py can run
+    and be measured without hardware.
+
+    Handles A0/A1/A2 address bytes, CD reads (count 0 is a 64K word block), E8
+    flash buffer writes, E9 PSRAM writes and the C5 internal commands (version,
+    PCB, mode switch, LPC lock) in front of a 4MB EmulatedFlash and a 4MB PSRAM.
+    The FT245BM link is modelled with a transfer rate, the USB frame delay of
+    host writes and the latency timer that holds back short replies. v5 and
+    newer hardware stalls commands while the flash is busy, older hardware loses
+    them (counted in flash.overruns).
+
+    With realtime=0 the emulator runs on simulated time: now() and sleep() only
+    move a virtual clock, so link bound runs finish instantly and reproducibly.
+    A port name emu[:key=value,...] selects it, for example
+    emu:version=0x20,region=4 or emu:latency_timer=0.002,realtime=1"""
+
+    size = 4*1024*1024
+    rx_fifo = 384       # FT245BM receive FIFO bytes
+
+    def __init__(self, version=0x20, pcb=4, region=0, bandwidth=1000000.0,
+                 usb_frame=0.001, latency_timer=0.016, erase_time=1.0,
+                 program_time=0.0002, realtime=0, timeout=6000):
+        self.version = version
+        self.pcb = pcb
+        self.region = region
+        self.bandwidth = float(bandwidth)
+        self.usb_frame = usb_frame
+        self.latency_timer = latency_timer
+        self.realtime = realtime
+        self.timeout = timeout
+        self.flash = EmulatedFlash(self.size, erase_time, program_time)
+        self.psram = bytearray('\xff'*self.size)
+        self.addr = 0
+        self.lpc_lock = 0
+        self.e8_left = 0        # words of a buffer write still to come
+        self.e8_words = 0
+        self.e9_left = 0        # words of a PSRAM write still to come
+        self.pend = ""          # received bytes not yet making up a command
+        self.rx = []            # replies as [ready time, data]
+        self.rx_free = 0.0      # when the dongle to host direction is idle again
+        self.clock = 0.0
+        self.tx_free = 0.0      # when the host to dongle direction is idle again
+        self.writes = 0         # transport calls and traffic, for benchmarks
+        self.reads = 0
+        self.round_trips = 0    # times the host had to wait for a reply
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.dongle_free = 0.0  # when the dongle has processed everything received
+        if realtime:
+            self.clock = monotonic_time()
+
+    def from_name(name, timeout=6000):
+        """Build an emulator from a emu[:key=value,...] port name"""
+        args = {}
+        if name.find(":") > -1:
+            for item in name.split(":", 1)[1].split(","):
+                if item == "":
+                    continue
+                key, value = item.split("=", 1)
+                try:
+                    args[key] = int(value, 0)
+                except ValueError:
+                    args[key] = float(value)
+        try:
+            return DongleEmulator(timeout=timeout, **args)
+        except TypeError:
+            raise SerialPortException('Bad emulator parameters ' + name)
+    from_name = staticmethod(from_name)
+
+    #### link clock ####
+    def now(self):
+        if self.realtime:
+            self.clock = max(self.clock, monotonic_time())
+        return self.clock
+
+    def sleep(self, seconds):
+        self.advance(self.now() + seconds)
+
+    def settle(self):
+        """Let time pass until the dongle has processed everything sent so far"""
+        self.advance(max(self.tx_free, self.dongle_free, self.flash.busy_until))
+
+    def advance(self, t):
+        """Let time pass until t"""
+        if self.realtime:
+            DongleTransport.sleep(self, t - monotonic_time())
+        self.clock = max(self.clock, t)
+
+    #### transport interface ####
+    def fileno(self):
+        return None
+
+    def write(self, s):
+        s = str(s)
+        self.writes += 1
+        self.bytes_out += len(s)
+        t = max(self.now() + self.usb_frame, self.tx_free)
+        self.pend = self.pend + s
+        self.__process(t)
+        return len(s)
+
+    def outWaiting(self):
+        return max(int((self.tx_free - self.now())*self.bandwidth), 0)
+
+    def __ready(self, byteCount):
+        """Time when byteCount reply bytes are available, None if never"""
+        got = 0
+        for (t, data) in self.rx:
+            got += len(data)
+            if got >= byteCount:
+                return t
+        return None
+
+    def inWaiting(self):
+        now = self.now()
+        got = 0
+        for (t, data) in self.rx:
+            if t > now:
+                break
+            got += len(data)
+        return got
+
+    def waitInput(self, byteCount, timeout=None):
+        if timeout==None:
+            timeout = self.timeout/1000.0
+        deadline = self.now() + timeout
+        t = self.__ready(byteCount)
+        if t != None and t <= deadline:
+            if t > self.clock:
+                self.round_trips += 1
+            self.advance(t)
+        else:
+            self.advance(deadline)
+        return self.inWaiting()
+
+    def read(self, num=1):
+        t = self.__ready(num)
+        if t == None:
+            self.sleep(self.timeout/1000.0)
+            print 'Expected %i bytes but got %i before timeout'%(num,self.inWaiting())
+            raise SerialPortException('Timeout')
+        self.reads += 1
+        self.bytes_in += num
+        if t > self.clock:
+            self.round_trips += 1
+        self.advance(t)
+        out = []
+        got = 0
+        while got < num:
+            (t, data) = self.rx[0]
+            if got + len(data) > num:
+                self.rx[0][1] = data[num-got:]
+                data = data[:num-got]
+            else:
+                del self.rx[0]
+            out.append(data)
+            got += len(data)
+        return "".join(out)
+
+    def flush(self):
+        self.rx = []
+        self.pend = ""
+
+    #### usb2mem model ####
+    def __reply(self, t, data):
+        t = max(t, self.rx_free) + len(data)/self.bandwidth     # replies go out one after another
+        self.rx_free = t
+        if len(data) % 62:
+            t += self.latency_timer     # last short USB packet waits for the latency timer
+        else:
+            t += self.usb_frame
+        if self.rx and self.rx[-1][0] > t:
+            t = self.rx[-1][0]
+        self.rx.append([t, data])
+
+    def __memory_word(self):
+        return (self.addr*2) % self.size
+
+    def __psram_store(self, data):
+        a = self.__memory_word()
+        split = min(len(data), self.size - a)
+        self.psram[a:a+split] = data[:split]
+        self.psram[:len(data)-split] = data[split:]    # address wraps around the window
+
+    def __process(self, link):
+        # commands are handled as their bytes arrive, link is when the last
+        # byte arrived and t the dongle time. While the dongle stalls the link
+        # only fills the FT245 receive FIFO, then flow control holds it
+        t = max(link, self.dongle_free)
+        byte_time = 1.0/self.bandwidth
+        fifo_time = self.rx_fifo*byte_time
+        buf = self.pend
+        i = 0
+        n = len(buf) & ~1
+        while i < n:
+            if self.e9_left:
+                # PSRAM block data goes straight to memory, bytes are swapped in hardware
+                cnt = min(self.e9_left*2, n - i)
+                link = max(link, t - fifo_time) + cnt*byte_time
+                t = max(t, link)
+                self.__psram_store(buf[i:i+cnt])
+                self.addr += cnt/2
+                self.e9_left -= cnt/2
+                i += cnt
+                continue
+            if self.e8_left:
+                # count word goes to the flash buffer first, then the data words
+                if self.version >= 5:
+                    t = max(t, self.flash.busy_until)
+                if self.e8_words == 0:
+                    link = max(link, t - fifo_time) + 2*byte_time
+                    t = max(t, link)
+                    self.flash.command(self.addr, ord(buf[i+1]), t)
+                    self.e8_words = 1
+                    self.e8_left -= 1
+                    i += 2
+                    continue
+                cnt = min(self.e8_left*2, n - i)
+                link = max(link, t - fifo_time) + cnt*byte_time
+                t = max(t, link)
+                if self.e8_words > 1:
+                    self.addr += 1      # address stays put for the first data word
+                self.flash.load_buffer(self.addr, bytearray(buf[i:i+cnt]))
+                self.addr += cnt/2 - 1
+                self.e8_words += cnt/2
+                self.e8_left -= cnt/2
+                i += cnt
+                continue
+            data = ord(buf[i])
+            code = ord(buf[i+1])
+            i += 2
+            link = max(link, t - fifo_time) + 2*byte_time
+            t = max(t, link)
+            if code == 0xA0:
+                self.addr = (self.addr & 0xFFFF00) | data
+            elif code == 0xA1:
+                self.addr = (self.addr & 0xFF00FF) | (data << 8)
+            elif code == 0xA2:
+                self.addr = (self.addr & 0x00FFFF) | (data << 16)
+            elif code == 0x3F:
+                pass
+            elif code == 0xC5:
+                self.__internal(data, t)
+            elif code == 0xCD:
+                count = data or 65536
+                if self.region > 3:
+                    a = self.__memory_word()
+                    reply = str(self.psram[a:a+count*2])
+                    if len(reply) < count*2:   # address wraps around the window
+                        reply = reply + str(self.psram[:count*2-len(reply)])
+                else:
+                    if self.version >= 5:
+                        t = max(t, self.flash.busy_until)
+                    reply = self.flash.read(self.addr, count, t)
+                self.addr = (self.addr + count) & 0xFFFFFF
+                self.__reply(t, reply)
+            elif code == 0xE8 and self.region <= 3:
+                if self.version >= 5:
+                    t = max(t, self.flash.busy_until)
+                self.flash.command(self.addr, 0xE8, t)
+                self.e8_left = data + 1
+                self.e8_words = 0
+            elif code == 0xE9 and self.version > 0x19:
+                self.e9_left = data or 65536
+            elif self.region > 3:
+                self.__psram_store(pack('<H', (data << 8) | code))
+            else:
+                if self.version >= 5:
+                    t = max(t, self.flash.busy_until)
+                self.flash.command(self.addr, (data << 8) | code, t)
+        self.pend = buf[i:]
+        self.dongle_free = t
+        self.tx_free = max(self.tx_free, link)  # stalled commands hold back the host (flow control)
+
+    def __internal(self, data, t):
+        if self.version < 5:
+            value = 0x3210      # internal commands beyond the check need HW ver 5
+        elif data == 0x00:
+            value = 0x3210
+        elif self.version <= 0x19:
+            value = 0x8600 | self.version
+        elif data == 0x01:
+            value = 0x8600 | self.version
+        elif data == 0x02:
+            value = self.pcb
+        elif data == 0x03:
+            value = self.region
+        elif data == 0xC2:
+            return              # board leaves USB mode, no reply
+        else:
+            if data == 0xC5:
+                self.lpc_lock = 1
+            elif data == 0xC6:
+                self.lpc_lock = 0
+            value = 0x8600 | self.version
+        self.__reply(t, pack('<H', value))
+
+
 #### Dongle code starts here  ##################################################################
 
 
@@ -609,11 +1309,17 @@ if sys.platform=='darwin':
 def usage(s):
     print "Artec USB Dongle programming utility ver. 2.7 prerelease"
     print "Usage:"
-    print "Write file      : ",s," [-vq] -c <name> <file> <offset>"
-    print "Readback file   : ",s," [-vq] -c <name> [-vq] -r <offset> <length> <file>"
+    print "Write file      : ",s," [-vqdkKs] -c <name> <file> <offset>"
+    print "Readback file   : ",s," [-vqs] -c <name> [-vq] -r <offset> <length> <file> [<offset> <length> <file> ...]"
     print "Options:"
     print " <file> <offset> When file and offset are given file will be written to dongle"
-    print "        file:    File name to be written to dongle"
+    print "        file:    File name to be written to dongle, - reads it from stdin."
+    print "                 Intel HEX, S-record and ELF images are written segment by"
+    print "                 segment, only the blocks they touch are erased. Their"
+    print "                 addresses wrap at 4MB and offset is added to them"
+    print "                 On HW version 5+ stdin is written as it arrives when none"
+    print "                 of EOF, -d, -k or -s need the whole image first."
+    print "                 gzip, xz and zstd images are decompressed on the way"
     print "        offset:  Specifies data writing starting point in bytes to 4M window"
     print "                 For ThinCan boot code the offset = 4M - filesize. To write"
     print "                 256K file the offset must be 3840K or EOF"
@@ -623,6 +1329,8 @@ def usage(s):
     print " -c <name>       Indicate port name where the USB Serial Device is"
     print "        name:    COM port name in Windows or Linux Examples: COM3,/dev/ttyS3"
     print "                 See Device Manager in windows for USB Serial Port number"
+    print "                 emu[:key=value,...] uses the built in dongle emulator"
+    print "                 Example: emu:version=0x20,region=4,realtime=1"
     print " "
     print " -v              Enable verbose mode. Displays more progress information"
     print " "
@@ -634,9 +1342,26 @@ def usage(s):
     print "                 use 0x prefix to indicate hexademical number format"
     print "        length:  Amount in bytes to read starting from offset. Example: 1M"
     print "                 use M for MegaBytes, K for KiloBytes, none for bytes"
-    print "        file:    Filename where data will be written"
+    print "        file:    Filename where data will be written, - streams it to stdout."
+    print "                 Names ending .gz .xz or .zst are compressed on the way"
+    print "                 More <offset> <length> <file> sets can follow, they are read"
+    print "                 in one session with overlapping and nearby ranges read once"
     print " "
     print " -e              Erase device. Erases Full 4 MegaBytes"    
+    print " -k              Verify written data. On HW version 5+ each part is read back"
+    print "                 and compared while the following parts are being written"
+    print " -K              Verify and reprogram the blocks that differ, then verify again"
+    print " -f              Erase every block. Without it blocks that read back all 0xFF"
+    print "                 are not erased again (HW version 5+)"
+    print " -d              Differential write. Reads the range back first and only erases"
+    print "                 and writes the 64K word blocks that differ (HW version 5+)"
+    print " -s              Use the shadow cache: a copy of the flash blocks this tool last"
+    print "                 wrote or read on the dongle, kept in ~/.dongle_shadow or in"
+    print "                 $DONGLE_SHADOW. Held blocks are not read over the link again"
+    print "                 for -r readback (HW version 5+), -d and blank checks always"
+    print "                 read the flash. Needs the USB serial number of the port from"
+    print "                 /dev/serial/by-id. A short read of each held block checks it"
+    print "                 before it is used"
     print "Board test options: "
     print " -t              Marching one and zero test. Device must be empty"
     print "                 To test dongle erase the flash with command -e"
@@ -645,6 +1370,9 @@ def usage(s):
     print " -b              Leave flash blank after test. Used with option -t"
     print " -l              Fast poll loop test. Does poll loop 1024 times"
     print "                 used to stress test connection"
+    print " -m <file>       Write counts, bytes and latency histograms of the dongle"
+    print "                 commands to file at the end, Prometheus text format when"
+    print "                 the name ends .prom and JSON otherwise"
     print " -p and -P       Used to change ldev_present_n signal on Dongle II LPC interface"
     print "                 -p will cause the signal to go low and -P to go high"
     print "                 from reset and when dongle FPGA is not configured the signal is low."
@@ -672,6 +1400,8 @@ class DongleMode:
         self.l = 0
         self.p = 0
         self.u = 0
+        self.k = 0
+        self.s = 0
         self.filename=""
         self.portname=""
         self.address=-1
@@ -680,8 +1410,12 @@ class DongleMode:
         self.oddAddr=0
         self.offset=-1
         self.length=-1
+        self.ranges=[]      # readback [offset, length, file] sets
         self.version=4
+        self.pcb=-1
         self.region=-1
+        self.shadow=None
+        self.metrics=""     # -m file for the command stats
      
     def convParamStr(self,param):
         mult = 1
@@ -704,35 +1438,375 @@ class DongleMode:
         return value
 
     
+
+class LinkPacer:
+    """Time based pacing of the dongle link. All waits are measured on the
+    link clock (monotonic for real ports) and derived from what the link is
+    observed doing (host output queue drain, command round trip time) instead of
+    CPU calibrated busy loops"""
+
+    open_retry_delay = 0.1     # seconds between serial port open attempts
+    frame_gap = 0.0003         # idle time pre v5 dongles need after a buffer write frame (250us + margin)
+    drain_timeout = 1.0        # longest wait for the output queue to empty
+    short_reply = 2            # status and handshake replies, only these time the round trip
+
+    def __init__(self, tty):
+        self.tty = tty
+        self.rtt = None         # smoothed command round trip time in seconds
+        self.sent_time = None
+
+    def open_retry_wait():
+        time.sleep(LinkPacer.open_retry_delay)
+    open_retry_wait = staticmethod(open_retry_wait)
+
+    def now(self):
+        return self.tty.now()
+
+    def sleep_until(self, deadline):
+        self.tty.sleep(deadline - self.tty.now())
+
+    def sleep(self, seconds):
+        self.tty.sleep(seconds)
+
+    def sent(self):
+        """Mark that a command expecting a reply went out"""
+        self.sent_time = self.tty.now()
+
+    def received(self):
+        """Reply to the last sent command arrived, update round trip estimate.
+        Only for a lone short reply, a long or queued one also holds its
+        transfer and the wait behind the replies ahead of it"""
+        if self.sent_time==None:
+            return
+        sample = self.tty.now() - self.sent_time
+        self.sent_time = None
+        if self.rtt==None:
+            self.rtt = sample
+        else:
+            self.rtt = self.rtt*0.875 + sample*0.125
+
+    def drain(self):
+        """Wait until the host output queue has been handed to the device.
+        Returns 0 if the port can't report its output queue"""
+        try:
+            left = self.tty.outWaiting()
+        except (IOError, NameError, AttributeError):
+            return 0
+        deadline = self.tty.now() + self.drain_timeout
+        while left > 0 and self.tty.now() < deadline:
+            self.tty.sleep(0.0001)
+            left = self.tty.outWaiting()
+        return 1
+
+    def wait_output(self, limit):
+        """Backpressure for streamed writes, wait until at most limit bytes are
+        queued for the port. v5 dongles stall the link while the flash is busy
+        so there is no time limit"""
+        try:
+            left = self.tty.outWaiting()
+        except (IOError, NameError, AttributeError):
+            return
+        while left > limit:
+            self.tty.sleep(0.0005)
+            left = self.tty.outWaiting()
+
+    def legacy_frame_gap(self):
+        """Pre v5 dongles have no write flow control, let each buffer write
+        frame reach the dongle and complete before sending the next one"""
+        if not self.drain():
+            if self.rtt!=None:
+                self.sleep(self.rtt/2)  # roughly the time for the frame to get out
+        self.sleep(self.frame_gap)
+
+
+class BusyTimer:
+    """Flash operations started on the dongle and not yet seen finished, and
+    the time each kind takes. wait_on_busy sleeps until the work should be
+    done, then polls with a doubling gap and gives up at the worst case
+    time. The time a chain of operations took to finish is shared out over
+    them, times holds the (kind, block, seconds) of each and the expected
+    time of a kind follows them"""
+
+    typical = {'erase': 1.0, 'program': 0.00025, 'unlock': 0.5}    # 28F320J3 data sheet
+    worst = {'erase': 5.0, 'program': 0.00065, 'unlock': 0.7}
+    early = 0.9             # first poll a little before the expected time
+    first_gap = 0.0005      # seconds to the second poll
+    idle_gap = 0.05         # longest gap when nothing known is running
+    margin = 1.0            # link time on top of the worst case
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.expected = self.typical.copy()
+        self.running = []       # (kind, block, start time)
+        self.streamed = 0       # frames went out behind the running work
+        self.times = []
+
+    def started(self, kind, block=-1):
+        now = self.clock.now()
+        if kind == 'program' and self.running and self.running[-1][:2] == (kind, block):
+            self.running[-1] = (kind, block, now)   # buffer writes to the same block
+        else:
+            self.running.append((kind, block, now))
+
+    def plan(self):
+        """(time the work should be done, time to give up, longest poll gap)"""
+        now = self.clock.now()
+        if not self.running:
+            return (now, now + self.worst['erase'] + self.margin, self.idle_gap)
+        done = worst = self.running[0][2]
+        for (kind, block, start) in self.running:   # the flash does one at a time
+            done = max(done, start) + self.expected[kind]*self.early
+            worst = max(worst, start) + self.worst[kind]
+        # writes streamed behind the work are not in running, allow for them
+        worst = max(worst, now + self.worst['erase'])
+        return (done, worst + self.margin, max((done - now)/8, self.first_gap))
+
+    def finished(self):
+        """The dongle reported ready, all started work is done. Gives the
+        (kind, block, seconds) of each operation, none when frames were
+        streamed behind them as the wait then includes writing those"""
+        seen = []
+        if self.running and not self.streamed:
+            # the flash does one at a time, the time from the first start
+            # less the gaps with nothing to do goes to each in proportion
+            # to its expected time
+            first = done = self.running[0][2]
+            idle = total = 0.0
+            for (kind, block, start) in self.running:
+                if start > done:
+                    idle = idle + start - done
+                    done = start
+                done = done + self.expected[kind]
+                total = total + self.expected[kind]
+            scale = max(self.clock.now() - first - idle, 0)/total
+            for (kind, block, start) in self.running:
+                seen.append((kind, block, self.expected[kind]*scale))
+            for (kind, block, seconds) in seen:
+                self.expected[kind] = self.expected[kind]*0.75 + seconds*0.25
+            self.times.extend(seen)
+        self.running = []
+        self.streamed = 0
+        return seen
+
+
+def latency_bucket(us):
+    # log linear bucket of a latency in microseconds, 8 buckets to each
+    # power of two so a bucket is at most 12.5% wide
+    if us < 8:
+        return us
+    e = us.bit_length() - 4
+    return ((e+1)<<3) + (us>>e) - 8
+
+
+def bucket_top(i):
+    # microseconds just above bucket i
+    if i < 8:
+        return i + 1
+    return ((i&7)+9) << ((i>>3)-1)
+
+
+class CommandStats:
+    """Counts, bytes and latency histograms of the dongle commands by class.
+    A command with a reply is timed from going out to the last byte of its
+    reply arriving, so queued reads include the wait behind the ones ahead.
+    Frame writes are timed by the write call, an erase by the status poll
+    seeing it finish. Recording is a clock read and a few dict updates"""
+
+    classes = ('handshake', 'address', 'read', 'block_read', 'e8_frame',
+               'e9_frame', 'status', 'erase')
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.start = clock.now()
+        self.count = dict.fromkeys(self.classes, 0)
+        self.bytes = dict.fromkeys(self.classes, 0)
+        self.seconds = dict.fromkeys(self.classes, 0.0)
+        self.hist = {}
+        for cls in self.classes:
+            self.hist[cls] = {}     # bucket -> samples
+        self.pending = collections.deque()  # [class, bytes, bytes left, time sent]
+
+    def add(self, cls, nbytes=0, seconds=None, n=1):
+        self.count[cls] += n
+        self.bytes[cls] += nbytes
+        if seconds!=None:
+            self.time(cls, seconds, n)
+
+    def time(self, cls, seconds, n=1):
+        i = latency_bucket(max(int(seconds*1000000), 0))
+        hist = self.hist[cls]
+        hist[i] = hist.get(i, 0) + n
+        self.seconds[cls] += seconds*n
+
+    def expect(self, cls, nbytes):
+        """A command with a reply of nbytes was queued"""
+        self.pending.append([cls, nbytes, nbytes, None])
+
+    def sent(self):
+        if self.pending and self.pending[-1][3]==None:
+            now = self.clock.now()
+            for entry in reversed(self.pending):
+                if entry[3]!=None:
+                    break
+                entry[3] = now
+
+    def received(self, nbytes):
+        if not self.pending:
+            return
+        now = self.clock.now()
+        while nbytes > 0 and self.pending:
+            entry = self.pending[0]
+            if nbytes < entry[2]:
+                entry[2] -= nbytes
+                return
+            nbytes -= entry[2]
+            self.pending.popleft()
+            self.add(entry[0], entry[1], now - (entry[3] or now))
+
+    def percentile(self, cls, p):
+        hist = self.hist[cls]
+        total = sum(hist.values())
+        if total == 0:
+            return None
+        seen = 0
+        for i in sorted(hist):
+            seen += hist[i]
+            if seen >= total*p:
+                return bucket_top(i)/1000000.0
+
+    def summary(self):
+        """The stats as a dict for JSON"""
+        commands = {}
+        for cls in self.classes:
+            hist = self.hist[cls]
+            commands[cls] = {
+                'count': self.count[cls],
+                'bytes': self.bytes[cls],
+                'timed': sum(hist.values()),
+                'seconds': round(self.seconds[cls], 6),
+                'p50': self.percentile(cls, 0.5),
+                'p90': self.percentile(cls, 0.9),
+                'p99': self.percentile(cls, 0.99),
+                'buckets': [[bucket_top(i)/1000000.0, hist[i]] for i in sorted(hist)]}
+        return {'session_seconds': round(self.clock.now()-self.start, 6),
+                'commands': commands}
+
+    def prometheus(self, labels):
+        """The stats in the Prometheus text format, labels is a dict of the
+        labels every sample gets"""
+        base = ",".join(['%s="%s"'%(k, str(labels[k]).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n'))
+                         for k in sorted(labels)])
+        if base:
+            base = base + ","
+        lines = []
+        lines.append('# HELP dongle_commands_total Commands sent to the dongle')
+        lines.append('# TYPE dongle_commands_total counter')
+        for cls in self.classes:
+            lines.append('dongle_commands_total{%scommand="%s"} %i'%(base, cls, self.count[cls]))
+        lines.append('# HELP dongle_command_bytes_total Bytes sent or received by the commands')
+        lines.append('# TYPE dongle_command_bytes_total counter')
+        for cls in self.classes:
+            lines.append('dongle_command_bytes_total{%scommand="%s"} %i'%(base, cls, self.bytes[cls]))
+        lines.append('# HELP dongle_command_seconds Command latency')
+        lines.append('# TYPE dongle_command_seconds histogram')
+        for cls in self.classes:
+            hist = self.hist[cls]
+            seen = 0
+            for i in sorted(hist):
+                seen += hist[i]
+                lines.append('dongle_command_seconds_bucket{%scommand="%s",le="%g"} %i'%(base, cls, bucket_top(i)/1000000.0, seen))
+            lines.append('dongle_command_seconds_bucket{%scommand="%s",le="+Inf"} %i'%(base, cls, seen))
+            lines.append('dongle_command_seconds_sum{%scommand="%s"} %.6f'%(base, cls, self.seconds[cls]))
+            lines.append('dongle_command_seconds_count{%scommand="%s"} %i'%(base, cls, seen))
+        lines.append('# HELP dongle_session_seconds Time since the port was opened')
+        lines.append('# TYPE dongle_session_seconds gauge')
+        lines.append('dongle_session_seconds{%s} %.6f'%(base[:-1], self.clock.now()-self.start))
+        return "\n".join(lines) + "\n"
     
     
+def open_transport(name, baud, timeout):
+    """Open the DongleTransport for a port name, emu[:...] is the emulator"""
+    if name.startswith("emu"):
+        return DongleEmulator.from_name(name, timeout)
+    elif sys.platform=='win32':
+        return SerialPortWin(name,timeout, baud)
+    elif sys.platform=='linux2': 
+        return SerialPortLin(name,timeout, baud)
+    elif sys.platform=='darwin': 
+        return SerialPortOSX(name,timeout, baud)
+
+
+def status_errors(statReg):
+    """Error messages for the error bits set in a flash status register value"""
+    errors = []
+    if (statReg>>5)&1 == 1:
+        errors.append("Block erase suspended")
+    if (statReg>>4)&3 == 3:
+        errors.append("Error in command order")  #if bits 4 and 5 are set then 
+    if (statReg>>4)&3 == 1:
+        errors.append("Error in setting lock bit")
+    if (statReg>>3)&1 == 1:
+        errors.append("Low Programming Voltage Detected, Operation Aborted")
+    if (statReg>>2)&1 == 1:
+        errors.append("Programming suspended")
+    if (statReg>>1)&1 == 1:
+        errors.append("Block lock bit detected")
+    return errors
+
+
 class Dongle:
-    def __init__(self,name, baud, timeout):  #time out in millis 1000 = 1s baud like 9600, 57600
+    def __init__(self,name, baud, timeout, transport=None):  #time out in millis 1000 = 1s baud like 9600, 57600
         self.mode = 0
         try:
-            if sys.platform=='win32':
-                self.tty = SerialPortWin(name,timeout, baud)
-            elif sys.platform=='linux2': 
-                self.tty = SerialPortLin(name,timeout, baud)
-            elif sys.platform=='darwin': 
-                self.tty = SerialPortOSX(name,timeout, baud)
+            if transport!=None:
+                self.tty = transport    # any DongleTransport
+            else:
+                self.tty = open_transport(name, baud, timeout)
             
         except SerialPortException , e:
             print "Unable to open port " + name
             sys.exit();
+        self.pacer = LinkPacer(self.tty)
+        self.timer = BusyTimer(self.tty)
+        self.stats = CommandStats(self.tty)
+        self.cmd_queue = []     # encoded commands not yet sent to the dongle
 
-    def testReturn(self,byteCount):
-        i=0
-        while don.tty.inWaiting()<byteCount:
-            i=i+1
-            if i==10000*byteCount:
-                break
-        if i==10000*byteCount:
+    def flush_commands(self, tail=""):
+        """Send all queued commands followed by tail in one write"""
+        if self.cmd_queue:
+            self.cmd_queue.append(tail)
+            s = "".join(self.cmd_queue)
+            self.cmd_queue = []
+        else:
+            s = tail
+        if len(s)==0:
+            return 0
+        ret = self.tty.write(s)
+        self.pacer.sent()
+        self.stats.sent()
+        if(ret<len(s)):
+            print 'flush_commands: Wrote less then needed %i bytes from %i'%(ret,len(s))
+        return ret
+
+    def write_raw(self, s):
+        """Write an already encoded command stream after the queued commands"""
+        return self.flush_commands(s)
+
+    def testReturn(self,byteCount,timeout=0.5):
+        self.flush_commands()
+        j=self.tty.waitInput(byteCount,timeout)  # seconds to wait for the reply
+        if j<byteCount:
             return 0
-        j=don.tty.inWaiting()
+        if self.lone_reply(j):
+            self.pacer.received()
         #print "Tested in waiting %i needed %i"%(j,byteCount)
         return j  ## ret two bytes            
             
+    def lone_reply(self,nbytes):
+        # nbytes complete the only reply on the way and it is a short one
+        pending = self.stats.pending
+        return len(pending) == 1 and pending[0][1] <= self.pacer.short_reply and nbytes >= pending[0][2]
+
     def getReturn(self,byteCount):
         i=0
         #while don.tty.inWaiting()<byteCount:
@@ -746,25 +1820,48 @@ class Dongle:
             
         #i=don.tty.inWaiting()
         #print "Read in waiting %i needed %i was %i"%(i,byteCount,don.tty.inWaiting())
-        buf = don.tty.read(byteCount)
+        self.flush_commands()  # the reply can't come before the command is sent
+        buf = self.tty.read(byteCount)  # waits up to port timeout for the data
+        if self.lone_reply(len(buf)):
+            self.pacer.received()
+        self.stats.received(len(buf))
         #print "Got bytes =%i "%(len(buf))
         return buf  ## ret two bytes
+
+    def getReturnInto(self,view):
+        # read a reply straight into the given writable buffer view
+        self.flush_commands()
+        got = self.tty.readinto(view)
+        if self.lone_reply(got):
+            self.pacer.received()
+        self.stats.received(got)
+        return got
+
+    def getReturnView(self,byteCount):
+        # same as getReturn but avoids copying large block reads where the port
+        # supports it, returned view is only valid until the next read
+        self.flush_commands()
+        buf = self.tty.readview(byteCount)
+        if self.lone_reply(len(buf)):
+            self.pacer.received()
+        self.stats.received(len(buf))
+        return buf
     
 
     def write_command(self,command):
         lsb = command&0xff
         msb = (command>>8)&0xff
         self.write_2bytes(msb,lsb)
+        if lsb == 0xC5:
+            self.stats.expect('handshake', 2)   # internal commands reply with a word
         
     def write_2bytes(self, msb,lsb):
-        """Write one word MSB,LSB to the serial port MSB first"""
+        """Queue one word MSB,LSB for the serial port MSB first. Queued words
+        go out in one write before the next read or at flush_commands()"""
         #print "---------->  CMD %02x %02x"%(msb,lsb)
-        s = pack('BB', msb, lsb)
-        ret = self.tty.write(s)
-        if(ret<len(s)):
-            print 'write_2byte: Wrote less then needed %i bytes from %i'%(ret,length(s))        
-        # Wait for the write to complete
-        #WaitForSingleObject(overlapped.hEvent, INFINITE)               
+        self.cmd_queue.append(pack('BB', msb, lsb))
+        if len(self.cmd_queue) >= 64:   # don't let a long sequence sit in the queue
+            self.flush_commands()
 
     def get_address_buf(self,address):  #set word address
         lsbyte = address&0xff
@@ -795,15 +1892,14 @@ class Dongle:
         self.write_2bytes(lsbyte,0xA0)            #set internal address to dongle
         self.write_2bytes(byte,0xA1)            #set internal address to dongle
         self.write_2bytes(msbyte,0xA2)            #send query command
+        self.stats.add('address', 6)
 
     def read_data(self,wordCount,address):
         command = 0
         byteCount = wordCount<<1  #calc byte count
         if wordCount>0 :
-            command = (command|wordCount)<<8
-            command = command|0xCD
             self.set_address(address)    # send read address
-            self.write_command(command)  # send get data command
+            self.issue_read(wordCount)   # send get data command
             return self.getReturn(byteCount)
         else:
             print "Word count can't be under 1"
@@ -817,18 +1913,36 @@ class Dongle:
         command = (command|wordCount)<<8
         command = command|0xCD
         self.write_command(command)  # send get data command
+        self.stats.expect('block_read', 65536*2)
+
+    def issue_read(self,wordCount):
+        # CD read of wordCount words from the current address, 0 is a 64K word block
+        self.write_command(((wordCount&0xFF)<<8)|0xCD)
+        if wordCount&0xFF:
+            self.stats.expect('read', (wordCount&0xFF)*2)
+        else:
+            self.stats.expect('block_read', 65536*2)
+
+    def write_frames(self,cls,s,frames=1):
+        # write_raw of frames of command class cls, timed by the write
+        start = self.tty.now()
+        ret = self.write_raw(s)
+        if frames:
+            self.stats.add(cls, len(s), (self.tty.now()-start)/frames, frames)
+        return ret
 
 
             
             
     def read_status(self):
-        don.write_command(0x0070) # 0x0098 //clear status
+        self.write_command(0x0070) # 0x0098 //clear status
         command = 0
         wordCount= 1  #calc byte count
         byteCount = wordCount<<1
         command = (command|wordCount)<<8
         command = command|0xCD
         self.write_command(command)  # send get data command
+        self.stats.expect('status', byteCount)
         return self.getReturn(byteCount)
 
     
@@ -836,37 +1950,44 @@ class Dongle:
         return address >> 16 # 16 bit mode block is 64Kwords
     
     def wait_on_busy(self):
-        exit=0
-        while exit==0:
+        # sleep through the expected time of what was started, then poll
+        # the status with a growing gap until it is ready or the worst case
+        # time has passed
+        start = self.tty.now()
+        (done, deadline, longest) = self.timer.plan()
+        self.pacer.sleep_until(done)
+        gap = self.timer.first_gap
+        while 1:
             buf=self.read_status()
-            statReg = ord(buf[0])  #8 bit reg
-            if statReg>>7 == 1:
-                exit=1
+            while len(buf)<2 and self.tty.now()<deadline:   # stalled behind the work
+                buf += self.getReturn(2-len(buf))
+            if len(buf)==2 and ord(buf[0])>>7 == 1:  #8 bit reg
+                break
+            if self.tty.now() >= deadline:
+                print "Flash still busy after %.1fs, giving up"%(self.tty.now()-start)
+                sys.exit()
+            self.pacer.sleep_until(min(self.tty.now()+gap, deadline))
+            gap = min(gap*2, longest)
+        for (kind, block, seconds) in self.timer.finished():
+            if kind == 'erase':
+                self.stats.time('erase', seconds)
+
+    def clear_lock_bits(self):
+        self.write_command(0x0060) #clear blockLock bits
+        self.write_command(0x00D0)
+        self.timer.started('unlock')
                 
-    def parse_status(self):  # use only after wait on busy commad to get result of the operation
-        exit = 0
+    def parse_status(self,fatal=1):  # use only after wait on busy commad to get result of the operation
         buf=self.read_status()
         statReg = ord(buf[0])  #8 bit reg
-        if (statReg>>5)&1 == 1:
-            print "Block erase suspended"
-            exit = 1
-        if (statReg>>4)&3 == 3:
-            print "Error in command order"  #if bits 4 and 5 are set then 
-            exit = 1
-        if (statReg>>4)&3 == 1:
-            print "Error in setting lock bit"
-            exit = 1
-        if (statReg>>3)&1 == 1:
-            print "Low Programming Voltage Detected, Operation Aborted"        
-            exit = 1
-        if (statReg>>2)&1 == 1:
-            print "Programming suspended"                
-            exit = 1
-        if (statReg>>1)&1 == 1:
-            print "Block lock bit detected"   
-            exit = 1
-        if exit == 1:
+        errors = status_errors(statReg)
+        if not fatal:
+            return errors   # the caller reports them
+        for e in errors:
+            print e
+        if errors:
             sys.exit()
+        return errors
                 
     def erase_block(self,blockNo):
         blockAddress = blockNo << 16
@@ -875,6 +1996,9 @@ class Dongle:
         self.write_command(command)  #issue block erase
         command = 0x00D0
         self.write_command(command)  #issue block erase confirm
+        self.flush_commands()        #start the erase now
+        self.timer.started('erase', blockNo)
+        self.stats.add('erase', 65536*2)
         #self.wait_on_busy()
         #self.parse_status()
     
@@ -895,7 +2019,7 @@ class Dongle:
             #    i=i+2
             #print "block write buffer size = %i"%(len(word_buf[:wordsWritten*2+65536*2]))
             buffer = buffer + word_buf[0:wordsWritten*2+65536*2]
-            self.tty.write(buffer)
+            self.write_frames('e9_frame',buffer)
             wordsWritten = wordsWritten + 65536 - 2  #two last words are written brokenly bu large block write
             length = length - 65536*2 + 4 # this amout has been written (two last words are written brokenly bu large block write)
         if length >= 32:  # can't write in one go so we must loop the code
@@ -913,7 +2037,7 @@ class Dongle:
                 #    i=i+2
                 #print "block write buffer size = %i"%(len(word_buf[wordsWritten*2:wordsWritten*2+32]))
                 buffer = buffer + word_buf[wordsWritten*2:wordsWritten*2+32]
-                self.tty.write(buffer) #ok buffer is filled
+                self.write_frames('e9_frame',buffer) #ok buffer is filled
                 wordsWritten = wordsWritten + 16
                 length = length - 32 # this amout has been written
         #and finally deal with smaller writes than 64K or 16 word blocks
@@ -933,14 +2057,23 @@ class Dongle:
             #    i=i+2
             #print "block write buffer size = %i"%(len(word_buf[wordsWritten*2:wordsWritten*2+length+length%2]))
             buffer = buffer + word_buf[wordsWritten*2:wordsWritten*2+length+length%2]
-            self.tty.write(buffer)             
+            self.write_frames('e9_frame',buffer)
         
                  
         
     def buffer_write(self,wordCount,startAddress,buffer):
+        start = self.tty.now()
+        self.buffer_write_frame(startAddress,buffer)
+        self.stats.add('e8_frame', FRAME_BYTES, self.tty.now()-start)
+        self.timer.started('program', startAddress>>16)
+        if self.mode.version <5:
+            self.pacer.legacy_frame_gap()
+
+    def buffer_write_frame(self,startAddress,buffer):
         # to speed up buffer writing compose all commands into one buffer
         # instead of multiple single writes this is needed as the FTDI chip
         # round lag is amazingly large with VCOM drivers
+        # no pacing here, pre v5 dongles need a gap after each frame
         #u = len(buffer)
         if len(buffer)<32:            #don't ever make unaligned writes
             i=len(buffer)
@@ -958,16 +2091,6 @@ class Dongle:
         cmd_buf+= chr(0xD0)
         wr_buffer_cmd = adrBuf + cmd_e8 + cmd_wcnt + buffer + cmd_buf   #44 bytes total
         self.write_buf_cmd(wr_buffer_cmd)
-        
-        if self.mode.version <5:
-            n = 0
-            if sys.platform=='win32':
-                while (n < 1024):
-                    n += 1;
-            elif sys.platform=='linux2' or sys.platform=='darwin':
-                #Linux FTDI VCP driver is way faster and needs longer grace time than windows driver
-                while (n < 1024*8):
-                    n += 1;                    
 
     def write_buf_cmd(self, buffer):
         """Write one word MSB,LSB to the serial port MSB first"""
@@ -981,17 +2104,18 @@ class Dongle:
             while(a < len(buffer)):
                 if a < 10:
                     s= pack('2c', buffer[a], buffer[a+1])
-                    self.tty.write(s)
+                    self.cmd_queue.append(s)
                 elif a < len(buffer)-2:
                     s= pack('2c', buffer[a+1], buffer[a])
-                    self.tty.write(s)
+                    self.cmd_queue.append(s)
                 elif  len(buffer)==2:
                     s=pack('2c', buffer[a], buffer[a+1])
-                    self.tty.write(s)
+                    self.cmd_queue.append(s)
                 else:
                      s=pack('2c', buffer[a], chr(0xFF))
-                     self.tty.write(s)
+                     self.cmd_queue.append(s)
                 a+=2       
+            self.flush_commands()
         else:
             #first 10 bytes are in correct order + 32 data bytes are in wrong order and + 2 confirm bytes are in correct order
             s=pack('44c', 
@@ -1002,97 +2126,1395 @@ class Dongle:
             buffer[33], buffer[32], buffer[35], buffer[34], buffer[37], buffer[36], buffer[39], buffer[38],
             buffer[41], buffer[40], buffer[42], buffer[43]
             )
-            ret = self.tty.write(s)
+            ret = self.write_raw(s)
+
+
+class CaptureTransport(DongleTransport):
+    """Transport that only collects what is written to it, used to encode
+    command streams before they are sent"""
+
+    def __init__(self):
+        self.out = []
+
+    def write(self, s):
+        self.out.append(str(s))
+        return len(s)
+
+
+# 44 byte buffer write frame: A0/A1/A2 address, E8 with count 16, flash
+# word count 15, 16 data words MSB first and D0 confirm
+FRAME_BYTES = 44
+FRAME_CONSTANTS = ((1, 0xA0), (3, 0xA1), (5, 0xA2), (6, 16), (7, 0xE8), (8, 0x00), (9, 0x0F),
+                   (42, 0x00), (43, 0xD0))
+if array.array('I').itemsize == 4:
+    ADDRESS_ARRAY = 'I'
+else:
+    ADDRESS_ARRAY = 'L'
+
+
+BLANK_FRAME = "\xff"*32
+
+
+def encode_frames(address, data, skipBlank=0):
+    """Buffer write frames programming data from word address, as one string.
+    A short last frame is padded with 0xFF. Gives the same bytes as
+    Dongle.buffer_write_frame() for every 32 bytes, but the data is byte
+    swapped in one go and each frame field is filled for all frames with
+    one slice assignment.
+    With skipBlank frames of all 0xFF data are left out, programming them
+    changes nothing in erased flash. Every frame carries its own address so
+    the rest need no changes"""
+    if len(data) % 32:
+        data = data + "\xff"*(32 - len(data) % 32)
+    frames = len(data)/32
+    if frames == 0:
+        return ""
+    if skipBlank and data.find(BLANK_FRAME) > -1:
+        out = []
+        start = None    # first frame of the current run of non blank frames
+        for i in xrange(frames):
+            if data[i*32:i*32+32] == BLANK_FRAME:
+                if start != None:
+                    out.append(encode_frames(address + start*16, data[start*32:i*32]))
+                    start = None
+            elif start == None:
+                start = i
+        if start != None:
+            out.append(encode_frames(address + start*16, data[start*32:]))
+        return "".join(out)
+    if (address + (frames-1)*16) >> 24:
+        print "Addressign fault. Too large address passed"
+        sys.exit()
+    words = array.array('H', data)
+    words.byteswap()    # data words go MSB first
+    swapped = words.tostring()
+    addresses = array.array(ADDRESS_ARRAY, xrange(address, address + frames*16, 16))
+    if sys.byteorder == 'big':
+        addresses.byteswap()
+    addresses = addresses.tostring()
+    out = bytearray(frames*FRAME_BYTES)
+    out[0::FRAME_BYTES] = addresses[0::4]
+    out[2::FRAME_BYTES] = addresses[1::4]
+    out[4::FRAME_BYTES] = addresses[2::4]
+    for (offset, value) in FRAME_CONSTANTS:
+        out[offset::FRAME_BYTES] = chr(value)*frames
+    for i in range(32):
+        out[10+i::FRAME_BYTES] = swapped[i::32]
+    return str(out)
 
 
 ############# Main program functions #################### 
 
-def flash_write(mode,don):
-    #Calculate number of blocks and start of blocks
-    size = 0
-    if mode.address&1 == 1:
-        mode.oddAddr=1
-    mode.address = mode.address>>1  #make word address
+def map_input(f):
+    # read only mapping of the whole file, slices of it are strings like
+    # f.read() gives. mmap can't map an empty file, that is ""
+    if not hasattr(f,"fileno"):
+        return f.getvalue()    # stdin already read into memory
+    f.seek(0,2)
+    if f.tell()==0:
+        return ""
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def map_output(f, size):
+    # (mapping, writable memoryview) of the file f grown to size bytes, None
+    # where it can't be mapped. The view lets replies be received right into
+    # the file pages. Only regular files opened by name are mapped
+    if ctypes==None or size==0 or not isinstance(f,file) or not os.path.isfile(f.name):
+        return None
     try:
-        f=open(mode.filename,"rb")
-        f.seek(0,2) #seek to end
-        size = f.tell()
-        f.seek(0) #seek to start
-        print 'File size %iK '%(size/1024)
-        f.close()
-    except IOError:
-         print "IO Error on file open. File missing or no premission to open."
-         don.write_command(0x00FF) # 0x0098  --set flash to read array mode
-         don.write_command(0xC6C5)   #clear lock bit
-         ret_buf=don.getReturn(2)    #two bytes expected to this command         
-         sys.exit()
-         
-    if mode.eof==1:
-        if (size&1==1):
-            mode.oddSize = 1            
-        region_size_w = 0x200000     # 4M region word count
-        #print "Given region size = %i bytes"%(region_size_w*2)
-        file_size_w = (size+ (size&1))>> 1
-        #print "Given file size = %i bytes"%(file_size_w*2)
-        mode.address = region_size_w - file_size_w
-        print "Offset will be 0x%x"%(mode.address*2)
-        
-         
-    #clear blockLock bits
-    don.write_command(0x0060) # 0x0098
-    don.write_command(0x00D0) # 0x0098
-    if mode.version < 5:
-        don.wait_on_busy()
-        don.parse_status()
-    wordSize = (size+ (size&1))>> 1    # round byte count up and make word address    
-    endBlock = don.get_block_no(mode.address+wordSize - 1)  
-    startBlock = don.get_block_no(mode.address)
-    if endBlock >= 32:
-        print "Given file does not fit into remaining space. File size is %i KB"%(size/1024)
-        print "Space left from given offset is %i KB"%((4*1024*1024-mode.address*2)/1024)
-        don.write_command(0x00FF) # 0x0098  --set flash to read array mode
-        don.write_command(0xC6C5)   #clear lock bit
-        ret_buf=don.getReturn(2)    #two bytes expected to this command                 
-        sys.exit()
-    i=startBlock
-    print 'Erasing from block %i to %i '%(i,endBlock)
-    while i <= endBlock:
-        if mode.v == 1:
-            print 'Erasing block %i '%(i)
-        else:
-            sys.stdout.write(".")
-            sys.stdout.flush()
-        don.erase_block(i)
-        if mode.version < 5:
-            don.wait_on_busy()
-            don.parse_status()   #do this after programming all but uneaven ending
-        i=i+1
-    if mode.v == 0:
-        print " "
-    f=open(mode.filename,"rb")
-    f.seek(0) #seek to start
-    address= mode.address
-    #don.set_address(address)
-    print 'Writing %iK'%(size/1024)
-    while 1:
-        if (address/(1024*64) != (address-16)/(1024*64)) and address != mode.address:  # get bytes from words if 512
-            if mode.v == 1:
-                print 'Progress: %iK of %iK at 0x%06x'%((address-mode.address)/512,size/1024,address)
+        f.truncate(size)
+        mapping = mmap.mmap(f.fileno(), size)
+    except (IOError, OSError, mmap.error):
+        return None
+    return (mapping, memoryview((ctypes.c_char*size).from_buffer(mapping)))
+
+
+def binary_stdio():
+    # images going through stdin and stdout need no newline translation
+    if sys.platform=='win32':
+        import msvcrt
+        msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+        msvcrt.setmode(data_out.fileno(), os.O_BINARY)
+
+
+# compressed images: codec, magic bytes at the start, file name ending
+CODECS = (("gzip", "\x1f\x8b", ".gz"),
+          ("xz", "\xfd7zXZ\x00", ".xz"),
+          ("zstd", "\x28\xb5\x2f\xfd", ".zst"))
+
+
+def new_codec(codec, compress):
+    # compressor or decompressor object of codec, both have the zlib
+    # compress/decompress and flush methods (lzma decompressors no flush)
+    if codec=="gzip":
+        if compress:
+            return zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+        return zlib.decompressobj(16+zlib.MAX_WBITS)
+    if codec=="xz":
+        if lzma==None:
+            print "xz images need the lzma module, on Python 2 install backports.lzma"
+            raise IOError("no lzma module")
+        if compress:
+            return lzma.LZMACompressor()
+        return lzma.LZMADecompressor()
+    if zstandard==None:
+        print "zstd images need the zstandard module"
+        raise IOError("no zstandard module")
+    if compress:
+        return zstandard.ZstdCompressor().compressobj()
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def stream_ended(decoder):
+    # whether decoder has seen the end marker of its stream. zlib on Python 2
+    # has no eof, but a byte after the end is left over as unused data
+    if hasattr(decoder, "eof"):
+        return decoder.eof
+    probe = decoder.copy()
+    try:
+        probe.decompress("\x00")
+    except zlib.error:
+        return 0
+    return probe.unused_data == "\x00"
+
+
+class ImageStream(threading.Thread):
+    """Image from a pipe or a compressed file, read and decompressed on its
+    own thread ahead of the link. read(n) gives n bytes unless the image
+    ends first, like a file does. Concatenated compressed streams are one
+    image, one cut short is an error"""
+
+    def __init__(self, f, codec, head, depth=8):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.f = f
+        self.head = head
+        self.codec = codec
+        self.decoder = None
+        if codec!=None:
+            self.decoder = new_codec(codec, 0)
+        self.error = None
+        self.chunks = Queue.Queue(depth)
+        self.data = []      # taken from chunks but not read yet
+        self.held = 0
+        self.done = 0
+
+    def run(self):
+        try:
+            data = self.head
+            while data:
+                if self.decoder!=None:
+                    data = self.decode(data)
+                self.chunks.put(data)
+                data = self.f.read(65536)
+            if self.decoder!=None:
+                if not stream_ended(self.decoder):
+                    raise IOError("compressed image is cut short")
+                self.chunks.put(self.end_stream())
+        except Exception, e:    # zlib, lzma and zstd each have their own error
+            self.error = e
+        self.chunks.put(None)
+
+    def decode(self, data):
+        # data after the end of a stream is the next one, as cat a.gz b.gz
+        # and pigz give, it gets a new decompressor
+        out = [self.decoder.decompress(data)]
+        rest = getattr(self.decoder, "unused_data", "")
+        while rest:
+            out.append(self.end_stream())
+            self.decoder = new_codec(self.codec, 0)
+            out.append(self.decoder.decompress(rest))
+            rest = getattr(self.decoder, "unused_data", "")
+        return "".join(out)
+
+    def end_stream(self):
+        if hasattr(self.decoder, "flush"):
+            return self.decoder.flush()
+        return ""
+
+    def read(self, n):
+        while self.held < n and not self.done:
+            chunk = self.chunks.get()
+            if chunk==None:
+                self.done = 1
+            elif chunk:
+                self.data.append(chunk)
+                self.held += len(chunk)
+        if self.error!=None and self.held < n:
+            print "Image read failed:",self.error
+            raise IOError(str(self.error))
+        data = "".join(self.data)
+        self.data = [data[n:]]
+        self.held = len(self.data[0])
+        return data[:n]
+
+    def peek(self, n):
+        data = self.read(n)
+        self.data.insert(0, data)
+        self.held += len(data)
+        return data
+
+
+class CompressWriter(threading.Thread):
+    """File like readback target that compresses on its own thread behind
+    the link. close() waits for it and closes the file it writes"""
+
+    def __init__(self, f, codec, depth=8):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.f = f
+        self.encoder = new_codec(codec, 1)
+        self.error = None
+        self.chunks = Queue.Queue(depth)
+
+    def write(self, s):
+        if self.error!=None:
+            raise IOError(str(self.error))
+        if isinstance(s, memoryview):
+            s = s.tobytes()     # the block buffer is used again
+        self.chunks.put(str(s))
+
+    def run(self):
+        while 1:
+            s = self.chunks.get()
+            if s==None:
+                break
+            if self.error==None:
+                try:
+                    self.f.write(self.encoder.compress(s))
+                except Exception, e:    # keep taking data so the reader never waits forever
+                    self.error = e
+        try:
+            if self.error==None:
+                self.f.write(self.encoder.flush())
+        except Exception, e:
+            self.error = e
+
+    def close(self):
+        self.chunks.put(None)
+        self.join()
+        self.f.close()
+        if self.error!=None:
+            raise IOError(str(self.error))
+
+
+def image_codec(head):
+    for (codec, magic, ending) in CODECS:
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def open_input(mode, stream=0):
+    # the image file. - is stdin and compressed files are decompressed on
+    # the way, those are an ImageStream when stream is set and are read into
+    # memory otherwise. More than the 4M window is never needed to see that
+    # an image does not fit
+    if mode.filename=="-":
+        binary_stdio()
+        f = sys.stdin
+    else:
+        f = open(mode.filename,"rb")
+    head = f.read(6)
+    codec = image_codec(head)
+    if codec==None and f!=sys.stdin:
+        f.seek(0)
+        return f
+    if codec!=None:
+        print 'Decompressing %s image'%(codec)
+    f = ImageStream(f,codec,head)
+    f.start()
+    if stream:
+        return f
+    return cStringIO.StringIO(f.read(4*1024*1024+1))
+
+
+def open_output(name):
+    # the readback file, - is stdout written block by block as they arrive.
+    # Names ending .gz .xz or .zst are compressed on the way
+    if name=="-":
+        binary_stdio()
+        data_out.flush()
+        return os.fdopen(os.dup(data_out.fileno()),"wb")
+    for (codec, magic, ending) in CODECS:
+        if name.endswith(ending):
+            f = CompressWriter(open(name,"wb"),codec)
+            f.start()
+            return f
+    return open(name,"w+b")  # + to map it
+
+
+def sparse_format(head):
+    # segmented image format recognized from the first bytes, None for flat
+    # binaries. Text formats must start with a record of hex digits
+    if head.startswith("\x7fELF"):
+        return "elf"
+    hexdigits = "0123456789abcdefABCDEF"
+    if len(head) >= 5 and head[0]==":" and not [c for c in head[1:5] if c not in hexdigits]:
+        return "ihex"
+    if len(head) >= 4 and head[0]=="S" and head[1] in "0123" and not [c for c in head[2:4] if c not in hexdigits]:
+        return "srec"
+    return None
+
+
+def hex_record(line, number):
+    # bytes of one hex text record, the checksum is left to the caller
+    try:
+        return [ord(c) for c in line.decode("hex")]
+    except (TypeError, ValueError):
+        raise ValueError("Bad record on line %i"%(number))
+
+
+def ihex_segments(text):
+    # (byte address, data) of the data records of an Intel HEX file
+    segments = []
+    base = 0
+    number = 0
+    for line in text.splitlines():
+        number = number + 1
+        line = line.strip()
+        if not line:
+            continue
+        if line[0]!=":":
+            raise ValueError("Bad record on line %i"%(number))
+        record = hex_record(line[1:], number)
+        if len(record) < 5 or len(record) != record[0]+5:
+            raise ValueError("Bad record length on line %i"%(number))
+        if sum(record) & 0xFF:
+            raise ValueError("Bad checksum on line %i"%(number))
+        kind = record[3]
+        data = record[4:-1]
+        if kind == 0x00:
+            segments.append((base + (record[1]<<8|record[2]), "".join([chr(b) for b in data])))
+        elif kind == 0x01:
+            break
+        elif kind == 0x02:      # extended segment address
+            base = (data[0]<<8|data[1])<<4
+        elif kind == 0x04:      # extended linear address
+            base = (data[0]<<8|data[1])<<16
+    return segments
+
+
+def srec_segments(text):
+    # (byte address, data) of the S1, S2 and S3 records of a Motorola
+    # S-record file
+    segments = []
+    number = 0
+    for line in text.splitlines():
+        number = number + 1
+        line = line.strip()
+        if not line:
+            continue
+        if line[0]!="S" or len(line) < 4:
+            raise ValueError("Bad record on line %i"%(number))
+        kind = line[1]
+        record = hex_record(line[2:], number)
+        if len(record) != record[0]+1:
+            raise ValueError("Bad record length on line %i"%(number))
+        if sum(record) & 0xFF != 0xFF:
+            raise ValueError("Bad checksum on line %i"%(number))
+        if kind in "123":
+            width = ord(kind) - ord("1") + 2    # address bytes
+            address = 0
+            for b in record[1:1+width]:
+                address = address<<8|b
+            segments.append((address, "".join([chr(b) for b in record[1+width:-1]])))
+        elif kind in "789":
+            break
+    return segments
+
+
+def elf_segments(data):
+    # (byte address, data) of an ELF file: the loadable program segments at
+    # their load address, or for objects without them (objcopy -O elf32-*)
+    # the allocated sections
+    if len(data) < 64 or ord(data[5]) not in (1, 2) or ord(data[4]) not in (1, 2):
+        raise ValueError("Unknown ELF header")
+    order = "<>"[ord(data[5])-1]
+    if ord(data[4]) == 1:
+        (phoff, shoff) = struct.unpack(order+"II", data[28:36])
+        (phentsize, phnum, shentsize, shnum) = struct.unpack(order+"HHHH", data[42:50])
+        phFormat = order+"IIIIII"    # type offset vaddr paddr filesz memsz
+        phFields = (0, 1, 3, 4)
+        shFormat = order+"IIIIII"    # name type flags addr offset size
+    else:
+        (phoff, shoff) = struct.unpack(order+"QQ", data[32:48])
+        (phentsize, phnum, shentsize, shnum) = struct.unpack(order+"HHHH", data[54:62])
+        phFormat = order+"IIQQQQ"    # type flags offset vaddr paddr filesz
+        phFields = (0, 2, 4, 5)
+        shFormat = order+"IIQQQQ"    # name type flags addr offset size
+    segments = []
+    for i in range(phnum):
+        at = phoff + i*phentsize
+        header = struct.unpack(phFormat, data[at:at+struct.calcsize(phFormat)])
+        (kind, offset, address, length) = [header[j] for j in phFields]
+        if kind == 1 and length > 0:    # PT_LOAD
+            segments.append((address, data[offset:offset+length]))
+    if segments:
+        return segments
+    for i in range(shnum):
+        at = shoff + i*shentsize
+        (name, kind, flags, address, offset, length) = struct.unpack(shFormat, data[at:at+struct.calcsize(shFormat)])
+        if kind == 1 and flags & 2 and length > 0:  # SHT_PROGBITS, SHF_ALLOC
+            segments.append((address, data[offset:offset+length]))
+    return segments
+
+
+def read_segments(f):
+    # the segments of a segmented image file, None for a flat binary
+    if isinstance(f,ImageStream):
+        kind = sparse_format(f.peek(8))
+    else:
+        kind = sparse_format(f.read(8))
+        f.seek(0)
+    if kind==None:
+        return None
+    data = f.read(1<<30)
+    if kind=="elf":
+        segments = elf_segments(data)
+    elif kind=="ihex":
+        segments = ihex_segments(data)
+    else:
+        segments = srec_segments(data)
+    if not segments:
+        raise ValueError("No data in the image")
+    print 'Found %s image with %i segments'%(kind,len(segments))
+    return segments
+
+
+def sparse_image(segments, offset, current=None):
+    # (byte address, image, touched blocks) of the segments placed in the 4M
+    # window. Addresses from 4M up wrap around, as the window repeats up to
+    # the top of the 4G LPC space, then offset is added. The gaps are 0xFF
+    # and the image starts and ends on whole frames. With current(block,
+    # count) giving what count blocks from block hold now, the image covers
+    # the touched blocks whole and keeps that content where no segment goes
+    window = 4*1024*1024
+    placed = []
+    for (address, data) in segments:
+        address = address % window + offset
+        if address + len(data) > window:
+            raise ValueError("Segment at 0x%x does not fit into the 4MB window"%(address))
+        placed.append((address, data))
+    touched = []
+    for (address, data) in placed:
+        for block in range(address>>17, ((address+len(data)-1)>>17)+1):
+            if block not in touched:
+                touched.append(block)
+    touched.sort()
+    if current==None:
+        start = min([address for (address, data) in placed]) & ~31
+        end = (max([address+len(data) for (address, data) in placed]) + 31) & ~31
+        image = bytearray("\xff"*(end-start))
+    else:
+        start = touched[0]<<17
+        end = (touched[-1]+1)<<17
+        image = bytearray("\xff"*(end-start))
+        i = 0
+        while i < len(touched):
+            j = i
+            while j+1 < len(touched) and touched[j+1] == touched[j]+1:
+                j = j + 1
+            lo = (touched[i]<<17) - start
+            image[lo:lo+((j-i+1)<<17)] = current(touched[i], j-i+1)
+            i = j + 1
+    for (address, data) in placed:
+        image[address-start:address-start+len(data)] = data
+    return (start, str(image), touched)
+
+
+def pipe_chunks(f, address, padFront):
+    # (word address, data) pieces of 64K words as they come from the pipe f
+    chunkBytes = 65536*2
+    while 1:
+        if padFront:
+            # odd start is front padded, then the frames stay aligned
+            data = "\xFF"+f.read(chunkBytes-1)
+            padFront = 0
+        else:
+            data = f.read(chunkBytes)
+        if len(data)==0:
+            break
+        yield (address, data)
+        address = address + (len(data)+31)/32*16
+        if len(data)<chunkBytes:
+            break
+
+
+def file_chunks(image, address):
+    # (word address, data) pieces of 64K words of the image
+    chunkBytes = 65536*2
+    pos = 0
+    while pos==0 or pos<len(image):
+        data = image[pos:pos+chunkBytes]
+        if len(data)==0:
+            break
+        yield (address, data)
+        address = address + (len(data)+31)/32*16
+        pos = pos + chunkBytes
+
+
+class FrameProducer(threading.Thread):
+    """Reads (word address, data) chunks from source and encodes them into
+    buffer write frames on its own thread while the main thread sends them.
+    The queue is bounded so memory use stays at a few chunks however large
+    the file is"""
+
+    def __init__(self, source, depth=4):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.source = source
+        self.error = None
+        self.chunks = Queue.Queue(depth)
+
+    def run(self):
+        try:
+            for (address, data) in self.source:
+                # everything written here has just been erased
+                self.chunks.put((address, data, encode_frames(address, data, 1)))
+        except IOError, e:
+            self.error = e
+        self.chunks.put(None)
+
+
+def stream_frames(mode,don,source,size,verifier=None,eraser=None):
+    # v5+ flash write, the dongle stalls the link while the flash is busy so
+    # frames are streamed without waiting. A FrameProducer reads and encodes
+    # ahead, the tty output queue is kept from growing past 64K.
+    # With a StreamVerifier each chunk is read back right after its frames,
+    # an EraseAhead erases the blocks of each chunk before it. size 0 is
+    # not known
+    producer = FrameProducer(source)
+    producer.start()
+    skipped = 0
+    while 1:
+        item = producer.chunks.get()
+        if item==None:
+            break
+        address, data, frames = item
+        length = len(data)
+        skipped = skipped + (length+31)/32 - len(frames)/FRAME_BYTES
+        if address != mode.address:
+            if mode.v == 1 and size == 0:
+                print 'Progress: %iK at 0x%06x'%((address-mode.address)/512,address)
+            elif mode.v == 1:
+                print 'Progress: %iK of %iK at 0x%06x'%((address-mode.address)/512,size/1024,address)
             else:
                 sys.stdout.write(".")
                 sys.stdout.flush()
-        if mode.oddSize==1 or mode.oddAddr==1:  
-            mode.oddSize = 0   # odd file size when writing BIOS to the end of region should be also front padded
-            mode.oddAddr = 0   # as odd address is shifted right padding should be added in front of data
-            buf = "\xFF"+f.read(31)  #16 words is maximum write here bytes are read
+        if length%32:
+            print "Doing an unaligned write..."
+        if eraser!=None:
+            eraser.before(address, length)
+        don.timer.streamed = 1
+        if verifier!=None:
+            start = don.tty.now()
+            verifier.send(frames)
+            if frames:
+                don.stats.add('e8_frame', len(frames), (don.tty.now()-start)*FRAME_BYTES/len(frames), len(frames)/FRAME_BYTES)
+            verifier.request(address, data)
         else:
-            buf = f.read(32)  #16 words is maximum write here bytes are read
-            
+            don.pacer.wait_output(65536)
+            don.write_frames('e8_frame', frames, len(frames)/FRAME_BYTES)
+    producer.join()
+    if skipped:
+        print "\nSkipped %i blank frames (%iK of 0xFF)"%(skipped,skipped/32)
+    if producer.error!=None:
+        raise producer.error
+
+
+class StreamVerifier:
+    """Overlapped verify of streamed writes. After a chunk has been sent its
+    read back is queued right behind it, the dongle returns it while the
+    next chunks are still coming in. Writes go out in small pieces and the
+    replies are collected whenever the writer waits for the output queue, a
+    dongle whose replies are not read stops taking commands"""
+
+    piece = 4096        # bytes written at a time
+
+    def __init__(self, mode, don, flash=1):
+        self.mode = mode
+        self.don = don
+        self.flash = flash
+        self.pending = []       # (word address, data, reply bytes) to come back
+        self.rx = bytearray()
+        self.mismatches = []    # byte offsets in the 4M window that differ
+        self.errors = []        # flash status errors
+        self.bad = []           # (word address, data) of chunks that differ
+
+    def send(self, s):
+        view = memoryview(s)
+        for i in range(0, len(s), self.piece):
+            self.wait_output(self.piece)
+            self.don.write_raw(view[i:i+self.piece].tobytes())
+
+    def request(self, address, data):
+        """Queue the read back of data at word address behind what was sent"""
+        replyBytes = 0
+        if self.flash:
+            self.don.write_command(0x0070) # status of the program
+            self.don.write_command(0x01CD)
+            self.don.stats.expect('status', 2)
+            self.don.write_command(0x00FF) # read array
+            replyBytes = 2
+        self.don.set_address(address)
+        for (counts, nbytes) in read_plan((len(data)+1)/2):
+            issue_unit(self.don, counts)    # a block read's extra is dropped
+            replyBytes += nbytes
+        self.don.flush_commands()
+        self.pending.append((address, data, replyBytes))
+
+    def collect(self):
+        """Take in the replies that have arrived and compare complete ones"""
+        waiting = self.don.tty.inWaiting()
+        if waiting:
+            got = self.don.tty.read(waiting)
+            self.don.stats.received(len(got))
+            self.rx += got
+        while self.pending and len(self.rx) >= self.pending[0][2]:
+            (address, data, replyBytes) = self.pending.pop(0)
+            reply = self.rx[:replyBytes]
+            del self.rx[:replyBytes]
+            if self.flash:
+                for e in status_errors(reply[0]):
+                    if e not in self.errors:    # the bits stay set for the chunks after
+                        self.errors.append(e)
+                reply = reply[2:]
+            self.compare(address, data, reply)
+        return waiting
+
+    def compare(self, address, data, reply):
+        if reply[:len(data)] == data:
+            return
+        self.bad.append((address, data))
+        i = 0
+        while i < len(data):
+            if reply[i] != ord(data[i]):
+                if len(self.mismatches) < 16:
+                    print "\nVerify: at 0x%06x wrote %02x read %02x"%(address*2+i, ord(data[i]), reply[i])
+                self.mismatches.append(address*2+i)
+            i = i + 1
+
+    def wait_output(self, limit):
+        """Wait until at most limit bytes are queued for the port, collecting
+        replies meanwhile"""
+        while 1:
+            self.collect()
+            try:
+                left = self.don.tty.outWaiting()
+            except (IOError, NameError, AttributeError):
+                return
+            if left <= limit:
+                return
+            self.don.tty.sleep(0.0005)
+
+    def finish(self):
+        """Wait for the outstanding read backs, the timeout counts from the
+        last received data. Returns 1 if everything matched"""
+        self.don.flush_commands()
+        last = self.don.tty.now()
+        while self.pending:
+            need = self.pending[0][2] - len(self.rx)
+            self.don.tty.waitInput(need, 0.1)
+            if self.collect():
+                last = self.don.tty.now()
+            elif self.don.tty.now() - last > 6.0:
+                raise SerialPortException('Timeout')
+        return len(self.mismatches) == 0 and len(self.errors) == 0
+
+    def report(self):
+        for e in self.errors:
+            print e
+        if self.mismatches:
+            print "Verify FAILED: %i bytes differ in %i parts, first at 0x%06x"%(len(self.mismatches), len(self.bad), self.mismatches[0])
+        elif not self.errors:
+            print "Verify OK"
+
+
+class LegacyReader:
+    """Pre v5 readback with several 128 word reads queued ahead instead of
+    waiting out a round trip for each. Every read carries its own address as
+    read_data always did. The queue depth is the measured latency of a read
+    over the time one reply takes on the link, so the replies follow each
+    other back to back, bounded by the queued commands fitting in the FT245
+    receive FIFO"""
+
+    words = 128         # words per read
+    fifo = 128          # FT245BM receive FIFO bytes
+
+    def __init__(self, don):
+        self.don = don
+        self.depth = 1          # the first read alone gives the plain latency
+        self.latency = None     # shortest issue to reply time seen
+        self.gap = None         # shortest time between back to back replies
+
+    def tune(self, issued, arrived, last):
+        sample = arrived - issued
+        if self.latency==None or sample < self.latency:
+            self.latency = sample
+        if last!=None and issued < last:    # was queued behind the reply before
+            gap = max(arrived - last, 1e-6)
+            if self.gap==None or gap < self.gap:
+                self.gap = gap
+        limit = self.fifo/8     # each read is four command words
+        if self.gap==None:
+            self.depth = min(self.depth+1, limit)
+        else:
+            self.depth = max(1, min(int(self.latency/self.gap)+1, limit))
+
+    def chunks(self, address, byteCount):
+        """The byteCount bytes from word address, yielded in order as the
+        replies of up to 256 bytes arrive"""
+        don = self.don
+        clock = don.tty
+        step = self.words*2
+        pending = []    # (reply bytes, time the read went out)
+        asked = 0
+        got = 0
+        last = None
+        while got < byteCount:
+            sizes = []
+            while asked < byteCount and len(pending)+len(sizes) < self.depth:
+                words = min(self.words, (byteCount-asked+1)/2)
+                don.set_address(address+asked/2)
+                don.issue_read(words)
+                sizes.append(words*2)
+                asked = asked + step
+            if sizes:
+                don.flush_commands()
+                sent = clock.now()
+                pending.extend([(size, sent) for size in sizes])
+            (size, issued) = pending.pop(0)
+            buf = don.getReturn(size)
+            if len(buf)<size:
+                raise SerialPortException('Timeout')
+            arrived = clock.now()
+            self.tune(issued, arrived, last)
+            last = arrived
+            got = got + step
+            yield buf[:byteCount-got+step]
+
+    def read(self, address, byteCount):
+        return "".join(self.chunks(address, byteCount))
+
+
+def verify_legacy(mode,don,image,ranges):
+    # pre v5 verify of the (block, first byte, end byte) ranges of the image,
+    # read by a LegacyReader
+    verifier = StreamVerifier(mode,don,0)
+    don.write_command(0x00FF) #  put flash to data read mode
+    reader = LegacyReader(don)
+    for (block, lo, hi) in ranges:
+        offset = lo
+        for buf in reader.chunks(mode.address+lo/2,hi-lo):
+            data = image[offset:offset+len(buf)]
+            verifier.compare(mode.address+offset/2, data, bytearray(buf))
+            offset = offset + len(buf)
+    return verifier
+
+
+def verify_flash(mode,don,image,verifier,ranges,errors=None):
+    # finish or run the verify of the ranges written after a flash write,
+    # with -K reprogram the blocks that differ and check them again. errors
+    # are those of the status after the write. Returns 1 if the flash matches
+    if verifier==None:
+        print "Verifying"
+        verifier = verify_legacy(mode,don,image,ranges)
+    for e in errors or []:
+        if e not in verifier.errors:
+            verifier.errors.append(e)
+    verifier.report()
+    if mode.k != 2 or (not verifier.mismatches and not verifier.errors):
+        return not verifier.mismatches and not verifier.errors
+    blocks = []
+    for offset in verifier.mismatches:
+        if (offset/2)>>16 not in blocks:
+            blocks.append((offset/2)>>16)
+    if verifier.errors:
+        blocks = [block for (block, lo, hi) in ranges]
+    print 'Reprogramming %i blocks'%(len(blocks))
+    don.write_command(0x0050)  #clear status register, the error bits stay set until then
+    for block in blocks:
+        don.erase_block(block)
+        if mode.version < 5:
+            don.wait_on_busy()
+            don.parse_status()
+    redo = [(lo, hi) for (block, lo, hi) in ranges if block in blocks]
+    if mode.version >= 5:
+        verifier = StreamVerifier(mode,don)
+        source = [(mode.address+lo/2, image[lo:hi]) for (lo, hi) in redo]
+        stream_frames(mode,don,source,len(image),verifier)
+        verifier.finish()
+    else:
+        for (lo, hi) in redo:
+            for offset in range(lo, hi, 32):
+                buf = image[offset:min(offset+32, hi)]
+                if buf != BLANK_FRAME:
+                    don.buffer_write(16,mode.address+offset/2,buf)
+        don.wait_on_busy()
+        errors = don.parse_status(0)
+        verifier = verify_legacy(mode,don,image,ranges)
+        verifier.errors.extend(errors)
+    verifier.report()
+    return not verifier.mismatches and not verifier.errors
+
+
+def read_image(f,padFront):
+    # the whole image as it is placed at mode.address, a mapping of the file
+    # unless it needs the front pad
+    image = map_input(f)
+    if padFront:
+        image = "\xFF"+image[:]
+    return image
+
+
+class BlankCheck:
+    """File like target for read_blocks that only records which blocks read
+    back as all 0xFF, and stores them in the shadow cache if there is one.
+    A held block that differs from what was read drops the whole cache"""
+    def __init__(self, shadow=None, block=0):
+        self.blank = []
+        self.shadow = shadow
+        self.block = block
+
+    def write(self, s):
+        data = s.tobytes()
+        self.blank.append(data.count("\xff") == len(data))
+        if self.shadow!=None:
+            block = self.block+len(self.blank)-1
+            held = self.shadow.get(block)
+            if held!=None and held != data:
+                print "\nShadow cache does not match the flash in block %i, dropping it"%(block)
+                self.shadow.drop(range(32))
+            self.shadow.put(block, data)
+
+
+def blank_blocks(mode,don,blocks):
+    # v5+ blank check, returns the erase blocks that are already all 0xFF.
+    # Runs of consecutive blocks are read with one pipelined read. Always
+    # read from the flash, a skipped erase must not rest on the shadow cache
+    blank = []
+    i = 0
+    while i < len(blocks):
+        j = i
+        while j+1 < len(blocks) and blocks[j+1] == blocks[j]+1:
+            j = j + 1
+        check = BlankCheck(mode.shadow,blocks[i])
+        don.write_command(0x00FF) #  put flash to data read mode
+        don.set_address(blocks[i]<<16)
+        read_blocks(mode,don,check,(j-i+1)*65536*2)
+        for k in range(j-i+1):
+            if check.blank[k]:
+                blank.append(blocks[i+k])
+        i = j + 1
+    return blank
+
+
+def blocks_to_erase(mode,don,blocks,seen=None):
+    # leave out blocks that are already erased, a block read costs much less
+    # than the erase. Needs the v5 block read, -f erases all. seen has the
+    # blank state of blocks already read back whole, only the others are read
+    if mode.f == 1 or mode.version < 5 or len(blocks) == 0:
+        return blocks
+    if seen == None:
+        seen = {}
+    blank = [block for block in blocks if seen.get(block)]
+    unknown = [block for block in blocks if not seen.has_key(block)]
+    if unknown:
+        print 'Blank checking %i blocks '%(len(unknown))
+        blank = blank + blank_blocks(mode,don,unknown)
+        if mode.v == 0:
+            print " "
+    if blank:
+        print 'Skipping erase of %i blank blocks'%(len(blank))
+    return [block for block in blocks if block not in blank]
+
+
+def read_back(mode,don,address,byteCount):
+    # v5+ pipelined read of byteCount bytes from word address into memory
+    data = bytearray(byteCount)
+    if byteCount==0:
+        return data
+    if mode.region<4:
+        don.write_command(0x00FF) #  put flash to data read mode
+    don.set_address(address)
+    read_into(mode,don,memoryview(data))
+    if mode.v == 0:
+        print " "
+    return data
+
+
+def block_ranges(address,byteCount):
+    # (block number, first byte, end byte) of each erase block the image
+    # placed at word address covers, bytes counted from the image start
+    ranges = []
+    block = address>>16
+    while byteCount>0 and (block<<16) < address+(byteCount+1)/2:
+        lo = max(block<<16, address) - address
+        hi = min((block+1)<<16, address+(byteCount+1)/2) - address
+        ranges.append((block, lo*2, min(hi*2, byteCount)))
+        block = block + 1
+    return ranges
+
+
+def changed_blocks(mode,don,image,ranges):
+    # differential write: read back the parts of the image in ranges, runs
+    # of neighbouring blocks at a time. Gives the ranges whose part of the
+    # image differs from what the flash holds, and the blank state of the
+    # blocks the read covered whole for blocks_to_erase
+    print 'Reading back %iK to compare'%(sum([hi-lo for (block, lo, hi) in ranges])/1024)
+    changed = []
+    seen = {}
+    i = 0
+    while i < len(ranges):
+        j = i
+        while j+1 < len(ranges) and ranges[j+1][0] == ranges[j][0]+1:
+            j = j + 1
+        lo = ranges[i][1]
+        current = read_back(mode,don,mode.address+lo/2,ranges[j][2]-lo)
+        for (block, blo, bhi) in ranges[i:j+1]:
+            if current[blo-lo:bhi-lo] != image[blo:bhi]:
+                changed.append((block, blo, bhi))
+            if bhi-blo == 65536*2:
+                seen[block] = current.count("\xff", blo-lo, bhi-lo) == bhi-blo
+        i = j + 1
+    return (changed, seen)
+
+
+def diff_chunks(mode,image,changed):
+    # (word address, data) pieces of the image for the changed blocks only
+    for (block, lo, hi) in changed:
+        yield (mode.address+lo/2, image[lo:hi])
+
+
+class ShadowCache:
+    """Host side copy of the flash erase blocks of one dongle as this tool
+    last wrote or read them, a file per 64K word block in a directory per
+    dongle. A block is dropped before anything may change it and stored
+    again only when its whole content is known, so a held block can be
+    used in place of reading it over the link"""
+
+    block_bytes = 65536*2
+
+    def __init__(self, path):
+        self.path = path
+        self.checked = []   # held blocks known to match the flash in this session
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __file(self, block):
+        return os.path.join(self.path, "block%02i.bin"%(block))
+
+    def __size(self, block):
+        try:
+            return os.path.getsize(self.__file(block))
+        except OSError:
+            return -1
+
+    def has(self, block):
+        size = self.__size(block)
+        return size == 0 or size == self.block_bytes
+
+    def get(self, block):
+        """Content of the block, None if it is not held"""
+        try:
+            f = open(self.__file(block), "rb")
+            data = f.read()
+            f.close()
+        except IOError:
+            return None
+        if len(data) == 0:
+            return "\xff"*self.block_bytes
+        if len(data) != self.block_bytes:
+            return None
+        return data
+
+    def put(self, block, data):
+        name = self.__file(block)
+        if data.count("\xff") == len(data):
+            data = ""
+        try:
+            f = open(name+".tmp", "wb")
+            f.write(data)
+            f.close()
+            if sys.platform=='win32' and os.path.exists(name):
+                os.remove(name)
+            os.rename(name+".tmp", name)   # never a half written block
+            if block not in self.checked:
+                self.checked.append(block)
+        except (IOError, OSError), e:
+            print "Shadow cache write failed:",e
+
+    def drop(self, blocks):
+        for block in blocks:
+            if os.path.exists(self.__file(block)):
+                os.remove(self.__file(block))
+            if block in self.checked:
+                self.checked.remove(block)
+
+    def record(self, address, image, blocks):
+        """Store the blocks of blocks after image was written at word address
+        on erased flash"""
+        for (block, lo, hi) in block_ranges(address,len(image)):
+            if block in blocks:
+                data = bytearray("\xff"*self.block_bytes)
+                start = address*2 + lo - block*self.block_bytes
+                data[start:start+hi-lo] = image[lo:hi]
+                self.put(block, data)
+
+
+def port_serial(name):
+    # serial number of the USB adapter behind the port where the system
+    # shows it, None where it can't be found
+    byId = "/dev/serial/by-id"
+    if os.path.isdir(byId):
+        port = os.path.realpath(name)
+        for entry in os.listdir(byId):
+            if os.path.realpath(os.path.join(byId, entry)) == port:
+                return entry
+    return None
+
+
+def check_shadow(mode,don,blocks):
+    # the first time a held block of blocks is used in this session compare
+    # a short read at a random place in it with the cache, so a swapped
+    # dongle is noticed. A sample misses most writes by the target, that is
+    # why only -r readback takes blocks from the cache. The
+    # reads of all blocks go out together. On a mismatch the whole cache
+    # is dropped. Returns the blocks of blocks still held
+    shadow = mode.shadow
+    held = [block for block in blocks if shadow.has(block)]
+    todo = [block for block in held if block not in shadow.checked]
+    if not todo:
+        return held
+    words = 255
+    don.write_command(0x00FF) #  put flash to data read mode
+    samples = []
+    for block in todo:
+        offset = random.randrange(0, 65536-words)
+        don.set_address((block<<16)+offset)
+        don.issue_read(words)
+        samples.append((block, offset))
+    differ = []
+    for (block, offset) in samples:
+        buf = don.getReturn(words*2)
+        content = shadow.get(block)
+        if content==None or buf != content[offset*2:(offset+words)*2]:
+            differ.append(block)
+    if differ:
+        print "Shadow cache does not match the flash in block %i, dropping it"%(differ[0])
+        shadow.drop(range(32))
+        return []
+    shadow.checked.extend(todo)
+    return held
+
+
+def open_shadow(mode):
+    # shadow cache of the dongle the handshake found, None where it can not
+    # be trusted
+    if mode.version < 5:
+        print "Shadow cache needs dongle HW version 5 or newer"
+        return None
+    if mode.region > 3:
+        print "PSRAM content is lost at power off, not using the shadow cache"
+        return None
+    if mode.portname.startswith("emu"):
+        print "Emulator memory is new every run, not using the shadow cache"
+        return None
+    serial = port_serial(mode.portname)
+    if serial==None:
+        # a port name alone could be any dongle plugged in there
+        print "No USB serial number found for the port in /dev/serial/by-id, not using the shadow cache"
+        return None
+    root = os.environ.get("DONGLE_SHADOW", os.path.join(os.path.expanduser("~"), ".dongle_shadow"))
+    key = "%s-hw%02x-pcb%05i-region%i"%(serial, mode.version, max(mode.pcb,0), max(mode.region,0))
+    key = "".join([(c.isalnum() or c in "-_.") and c or "_" for c in key])
+    try:
+        return ShadowCache(os.path.join(root, key))
+    except OSError, e:
+        print "Shadow cache not available:",e
+        return None
+
+
+def cached_read(mode,don,address,byteCount):
+    # read_back for -r that takes the blocks held in the shadow cache from
+    # there and reads the others whole so they can be stored
+    shadow = mode.shadow
+    if shadow==None:
+        return read_back(mode,don,address,byteCount)
+    first = address>>16
+    last = (address+(byteCount+1)/2-1)>>16
+    check_shadow(mode,don,range(first,last+1))
+    data = bytearray()
+    held = 0
+    block = first
+    while block <= last:
+        content = shadow.get(block)
+        if content!=None:
+            data += content
+            held = held + 1
+            block = block + 1
+            continue
+        end = block
+        while end < last and not shadow.has(end+1):
+            end = end + 1
+        run = read_back(mode,don,block<<16,(end-block+1)*shadow.block_bytes)
+        for i in range(end-block+1):
+            shadow.put(block+i, run[i*shadow.block_bytes:(i+1)*shadow.block_bytes])
+        data += run
+        block = end + 1
+    if held:
+        print '%i of %i blocks taken from the shadow cache'%(held,last-first+1)
+    lo = (address-(first<<16))*2
+    return data[lo:lo+byteCount]
+
+
+class EraseAhead:
+    """Erases the blocks of a streamed write right before the first frames
+    going into each, for images whose size is not known up front. Without
+    -f a block that reads back blank is not erased"""
+    def __init__(self, mode, don):
+        self.mode = mode
+        self.don = don
+        self.erased = []
+
+    def before(self, address, length):
+        last = (address+(length+1)/2-1)>>16
+        if last >= 32:
+            print "\nGiven file does not fit into remaining space, written up to 0x%x"%(address*2)
+            self.don.write_command(0x00FF) # 0x0098  --set flash to read array mode
+            self.don.write_command(0xC6C5)   #clear lock bit
+            ret_buf=self.don.getReturn(2)    #two bytes expected to this command
+            sys.exit()
+        blocks = [block for block in range(address>>16, last+1) if block not in self.erased]
+        self.erased.extend(blocks)
+        if self.mode.f == 0 and blocks:
+            blank = blank_blocks(self.mode,self.don,blocks)
+            blocks = [block for block in blocks if block not in blank]
+        for block in blocks:
+            if self.mode.v == 1:
+                print 'Erasing block %i '%(block)
+            self.don.erase_block(block)
+
+
+def busy_report(mode,don):
+    # -v summary of the flash operation times seen while waiting on them
+    if mode.v != 1:
+        return
+    times = [(seconds, block) for (kind, block, seconds) in don.timer.times if kind == 'erase']
+    if times:
+        times.sort()
+        print 'Block erase %.3f to %.3fs, slowest block %i'%(times[0][0],times[-1][0],times[-1][1])
+
+
+def stream_write(mode,don,f):
+    # v5+ flash write of an image coming from stdin or a decompressor,
+    # written as it arrives. Every block it reaches is erased just before
+    print 'Writing as the image arrives'
+    don.clear_lock_bits()
+    source = pipe_chunks(f,mode.address,mode.oddAddr==1)
+    mode.oddAddr = 0
+    stream_frames(mode,don,source,0,None,EraseAhead(mode,don))
+    if mode.v == 0:
+        print " "
+    print "Waiting for buffers to empty"
+    don.wait_on_busy()
+    don.parse_status()
+    print "Write DONE!"
+
+
+def flash_write(mode,don):
+    #Calculate number of blocks and start of blocks
+    size = 0
+    if mode.address&1 == 1:
+        mode.oddAddr=1
+    mode.address = mode.address>>1  #make word address
+    # without these the size is not needed up front
+    canStream = mode.eof!=1 and mode.version>=5 and mode.d==0 and mode.k==0 and mode.shadow==None
+    try:
+        f=open_input(mode,canStream)
+        segments = read_segments(f)   # None for flat binaries
+        if segments==None and not isinstance(f,ImageStream):
+            f.seek(0,2) #seek to end
+            size = f.tell()
+            f.seek(0) #seek to start
+            print 'File size %iK '%(size/1024)
+    except IOError:
+         print "IO Error on file open. File missing or no premission to open."
+         don.write_command(0x00FF) # 0x0098  --set flash to read array mode
+         don.write_command(0xC6C5)   #clear lock bit
+         ret_buf=don.getReturn(2)    #two bytes expected to this command         
+         sys.exit()
+    except ValueError, e:
+         print "Bad image file:",e
+         don.write_command(0x00FF) # 0x0098  --set flash to read array mode
+         don.write_command(0xC6C5)   #clear lock bit
+         ret_buf=don.getReturn(2)    #two bytes expected to this command
+         sys.exit()
+    if segments==None and isinstance(f,ImageStream):
+        try:
+            stream_write(mode,don,f)
+        except IOError:
+            print "IO Error on file read"
+            don.write_command(0x00FF) # 0x0098  --set flash to read array mode
+            don.write_command(0xC6C5)   #clear lock bit
+            ret_buf=don.getReturn(2)    #two bytes expected to this command
+            sys.exit()
+        don.write_command(0x00FF) # 0x0098  --set flash to read array mode
+        return
+         
+    if segments!=None:
+        # segments go to their own addresses, the offset moves them all
+        if mode.eof==1:
+            print "EOF placement is for flat binaries, the segment addresses are used"
+            mode.address = 0
+        held = {}
+        def current(block, count):
+            # the touched blocks are erased whole, what the segments leave
+            # of them is read back and written again. From the flash, not
+            # the shadow cache, whatever it holds is written back
+            print 'Reading back %iK around the segments'%(count*128)
+            if mode.version >= 5:
+                data = read_back(mode,don,block<<16,count*65536*2)
+            else:
+                data = read_legacy(mode,don,block<<16,count*65536*2)
+            for i in range(count):
+                held[block+i] = data[i*65536*2:(i+1)*65536*2]
+            return data
+        try:
+            (start, image, touched) = sparse_image(segments,mode.address*2+mode.oddAddr,current)
+        except ValueError, e:
+            print e
+            don.write_command(0x00FF) # 0x0098  --set flash to read array mode
+            don.write_command(0xC6C5)   #clear lock bit
+            ret_buf=don.getReturn(2)    #two bytes expected to this command
+            sys.exit()
+        mode.address = start>>1
+        mode.oddAddr = 0
+        size = len(image)
+        print 'Segments touch %i blocks from 0x%06x to 0x%06x'%(len(touched),start,start+size)
+        ranges = [r for r in block_ranges(mode.address,len(image)) if r[0] in touched]
+    else:
+        if mode.eof==1:
+            if (size&1==1):
+                mode.oddSize = 1            
+            region_size_w = 0x200000     # 4M region word count
+            #print "Given region size = %i bytes"%(region_size_w*2)
+            file_size_w = (size+ (size&1))>> 1
+            #print "Given file size = %i bytes"%(file_size_w*2)
+            mode.address = region_size_w - file_size_w
+            print "Offset will be 0x%x"%(mode.address*2)
+        
+        padFront = mode.oddSize==1 or mode.oddAddr==1
+        mode.oddSize = 0
+        mode.oddAddr = 0
+        image = read_image(f,padFront)   # odd start is front padded, then the frames stay aligned
+        ranges = block_ranges(mode.address,len(image))
+    changed = None
+    verifier = None
+    seen = {}   # block -> all 0xFF, of the blocks already read back whole
+    if segments!=None:
+        changed = ranges
+        for block in held:
+            seen[block] = held[block].count("\xff") == len(held[block])
+    if mode.d == 1 and mode.version < 5:
+        print "Differential write needs dongle HW version 5 or newer, writing all blocks"
+    elif mode.d == 1:
+        if (mode.address*2+len(image)) > 4*1024*1024:
+            print "Given file does not fit into remaining space. File size is %i KB"%(size/1024)
+            don.write_command(0x00FF) # 0x0098  --set flash to read array mode
+            don.write_command(0xC6C5)   #clear lock bit
+            ret_buf=don.getReturn(2)    #two bytes expected to this command
+            sys.exit()
+        if segments!=None:
+            # the touched blocks were read back whole for the merge
+            changed = [r for r in ranges if held[r[0]] != image[r[1]:r[2]]]
+        else:
+            (changed, seen) = changed_blocks(mode,don,image,ranges)
+        print 'Blocks changed: %i of %i'%(len(changed),len(ranges))
+        if len(changed)==0:
+            print "Flash content matches the file, nothing to write"
+            don.write_command(0x00FF) # 0x0098  --set flash to read array mode
+            f.close()
+            return
+         
+    #clear blockLock bits
+    don.clear_lock_bits()
+    if mode.version < 5:
+        don.wait_on_busy()
+        don.parse_status()
+    wordSize = (size+ (size&1))>> 1    # round byte count up and make word address    
+    endBlock = don.get_block_no(mode.address+wordSize - 1)  
+    startBlock = don.get_block_no(mode.address)
+    if endBlock >= 32:
+        print "Given file does not fit into remaining space. File size is %i KB"%(size/1024)
+        print "Space left from given offset is %i KB"%((4*1024*1024-mode.address*2)/1024)
+        don.write_command(0x00FF) # 0x0098  --set flash to read array mode
+        don.write_command(0xC6C5)   #clear lock bit
+        ret_buf=don.getReturn(2)    #two bytes expected to this command                 
+        sys.exit()
+    if changed!=None:
+        writeBlocks = [block for (block, lo, hi) in changed]
+        eraseBlocks = blocks_to_erase(mode,don,writeBlocks,seen)
+        if segments!=None and mode.d == 0:
+            print 'Erasing %i blocks touched by the segments '%(len(eraseBlocks))
+        else:
+            print 'Erasing %i changed blocks '%(len(eraseBlocks))
+    else:
+        writeBlocks = range(startBlock,endBlock+1)
+        eraseBlocks = blocks_to_erase(mode,don,writeBlocks,seen)
+        print 'Erasing %i blocks from block %i to %i '%(len(eraseBlocks),startBlock,endBlock)
+    if mode.shadow!=None:
+        mode.shadow.drop(writeBlocks)
+    for i in eraseBlocks:
+        if mode.v == 1:
+            print 'Erasing block %i '%(i)
+        else:
+            sys.stdout.write(".")
+            sys.stdout.flush()
+        don.erase_block(i)
+        don.wait_on_busy()      # on v5 too, the stalled status reply times the erase
+        if mode.version < 5:
+            don.parse_status()   #do this after programming all but uneaven ending
+    if mode.v == 0:
+        print " "
+    address= mode.address
+    #don.set_address(address)
+    print 'Writing %iK'%(size/1024)
+    if mode.version >= 5:
+        if changed!=None:
+            source = diff_chunks(mode,image,changed)
+        else:
+            source = file_chunks(image,mode.address)
+        if mode.k:
+            verifier = StreamVerifier(mode,don)
+        try:
+            stream_frames(mode,don,source,size,verifier)
+        except IOError:
+            print "IO Error on file read"
+            don.write_command(0x00FF) # 0x0098  --set flash to read array mode
+            don.write_command(0xC6C5)   #clear lock bit
+            ret_buf=don.getReturn(2)    #two bytes expected to this command
+            sys.exit()
+        if verifier!=None:
+            verifier.finish()   # the read backs still on the way come before any status
+    pos = 0
+    while mode.version < 5:    # before v5 a frame at a time, with a gap after each
+        if (address/(1024*64) != (address-16)/(1024*64)) and address != mode.address:  # get bytes from words if 512
+            if mode.v == 1:
+                print 'Progress: %iK of %iK at 0x%06x'%((address-mode.address)/512,size/1024,address)
+            else:
+                sys.stdout.write(".")
+                sys.stdout.flush()
+        buf = image[pos:pos+32]  #16 words is maximum write here bytes are taken
+        pos = pos + 32
         if len(buf)==32:
-            don.buffer_write(16,address,buf)
+            if buf != BLANK_FRAME:    # 0xFF needs no programming after erase
+                don.buffer_write(16,address,buf)
             address = address + 16
         elif len(buf)>0:
-            don.parse_status()   #do this after programming all but uneaven ending
+            don.parse_status(mode.k != 2)   #do this after programming all but uneaven ending
             print "Doing an unaligned write..."
             length = len(buf)
             length = (length + (length&1))>> 1   #round up to get even word count
@@ -1107,10 +3529,15 @@ def flash_write(mode,don):
     if mode.version >= 5:
         print "Waiting for buffers to empty"
         don.wait_on_busy()
-        don.parse_status()   #do this after programming all but uneaven ending        
+    errors = don.parse_status(mode.k != 2)   # -K reprograms on errors too
     print "Write DONE!"
-    don.parse_status()   #do this after programming all but uneaven ending
+    busy_report(mode,don)
     f.close()                
+    verified = 1
+    if mode.k:
+        verified = verify_flash(mode,don,image,verifier,ranges,errors)
+    if mode.shadow!=None and verified:
+        mode.shadow.record(mode.address,image,writeBlocks)
     don.write_command(0x00FF) # 0x0098  --set flash to read array mode
     
     
@@ -1123,17 +3550,23 @@ def psram_write(mode,don):
     mode.address = mode.address>>1  #make word address
     #check that file exists
     try:
-        f=open(mode.filename,"rb")
+        f=open_input(mode)
+        if read_segments(f)!=None:
+            raise ValueError("segmented images are written to flash regions only")
         f.seek(0,2) #seek to end
         size = f.tell()
         f.seek(0) #seek to start
         print 'File size %iK '%(size/1024)
-        f.close()
     except IOError:
          print "IO Error on file open. File missing or no premission to open."
          don.write_command(0xC6C5)   #clear lock bit
          ret_buf=don.getReturn(2)    #two bytes expected to this command                  
          sys.exit()
+    except ValueError, e:
+         print "Bad image file:",e
+         don.write_command(0xC6C5)   #clear lock bit
+         ret_buf=don.getReturn(2)    #two bytes expected to this command
+         sys.exit()
 
     if mode.eof==1:
         if (size&1==1):
@@ -1157,9 +3590,14 @@ def psram_write(mode,don):
         ret_buf=don.getReturn(2)    #two bytes expected to this command                 
         sys.exit()
     i=startBlock
+    verifier = None
+    if mode.k:
+        verifier = StreamVerifier(mode,don,0)
     #Start writing the file content to dongle PSRAM
-    f=open(mode.filename,"rb")
-    f.seek(0) #seek to start
+    image = read_image(f,mode.oddSize==1 or mode.oddAddr==1)
+    mode.oddSize = 0
+    mode.oddAddr = 0
+    pos = 0
     address= mode.address
     #don.set_address(address)
     print 'Writing %iK'%(size/1024)
@@ -1170,20 +3608,15 @@ def psram_write(mode,don):
             else:
                 sys.stdout.write(".")
                 sys.stdout.flush()
-        if mode.oddSize==1 or mode.oddAddr==1:
-            mode.oddSize = 0
-            mode.oddAddr = 0
-            buf = "\xFF"+f.read(65536*2-1)  #65536 words is maximum write here bytes are read (*2 is byte count)
-        else:
-            buf = f.read(65536*2)  #65536 words is maximum write here bytes are read (*2 is byte count)
-            
+        buf = image[pos:pos+65536*2]  #65536 words is maximum write here bytes are taken (*2 is byte count)
+        pos = pos + 65536*2
         if len(buf)==65536*2:
-            don.buffer_write_ram(address,buf)
+            ram_write(don,address,buf,verifier)
             address = address + 65536  # add word count
         elif len(buf)>0:
             print "Doing an unaligned write..."
             length = len(buf)
-            don.buffer_write_ram(address,buf)
+            ram_write(don,address,buf,verifier)
             address = address + length//2     #inc word address
             break
         else:
@@ -1192,39 +3625,266 @@ def psram_write(mode,don):
         print " "       
     print "Write DONE!"
     f.close()         
+    if verifier!=None:
+        verifier.finish()
+        verifier.report()
+        if mode.k == 2 and verifier.bad:
+            print 'Rewriting %i parts'%(len(verifier.bad))
+            bad = verifier.bad
+            verifier = StreamVerifier(mode,don,0)
+            for (address, buf) in bad:
+                ram_write(don,address,buf,verifier)
+            verifier.finish()
+            verifier.report()
+
+
+def ram_write(don,address,buf,verifier):
+    # PSRAM block write, with a verifier its read back is queued behind it
+    if verifier==None:
+        don.buffer_write_ram(address,buf)
+        return
+    link = CaptureTransport()
+    capture = Dongle("capture",0,0,link)
+    capture.buffer_write_ram(address,buf)
+    frames = capture.stats.count['e9_frame']
+    start = don.tty.now()
+    verifier.send("".join(link.out))
+    don.stats.add('e9_frame', capture.stats.bytes['e9_frame'], (don.tty.now()-start)/frames, frames)
+    verifier.request(address,buf)
     
     
+class BlockWriter(threading.Thread):
+    """Writes read back blocks to the output file on its own thread so the
+    link keeps streaming while the file is written. Two block buffers go
+    around: the reader fills one while the writer empties the other"""
+
+    def __init__(self, f, buffers=2):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.f = f
+        self.error = None
+        self.free = Queue.Queue()
+        self.full = Queue.Queue()
+        for i in range(buffers):
+            self.free.put(bytearray(65536*2))
+
+    def run(self):
+        while 1:
+            item = self.full.get()
+            if item==None:
+                break
+            buf, start, end = item
+            if self.error==None:
+                try:
+                    self.f.write(memoryview(buf)[start:end])
+                except IOError, e:
+                    self.error = e  # keep taking blocks so the reader never waits forever
+            self.free.put(buf)
+
+    def finish(self):
+        """Wait for all blocks to be written, raises the write error if any"""
+        self.full.put(None)
+        self.join()
+        if self.error!=None:
+            raise self.error
+
+
+SMALL_READS = 64    # short reads a tail is split into before a whole block is asked for
+
+def read_plan(words):
+    # the CD reads for words from the set address as units of (word counts,
+    # reply bytes). Each whole 64K word block is a unit, a shorter tail is
+    # one unit of reads of up to 255 words sent together, unless it takes
+    # so many that one more block is cheaper
+    units = [([0], 65536*2)]*(words>>16)
+    tail = words&0xFFFF
+    if tail > 255*SMALL_READS:
+        units.append(([0], 65536*2))
+    elif tail:
+        counts = [255]*(tail/255)
+        if tail%255:
+            counts.append(tail%255)
+        units.append((counts, tail*2))
+    return units
+
+
+def issue_unit(don,counts):
+    for count in counts:
+        don.issue_read(count)  # address auto increments
+
+
+def read_blocks(mode,don,f,byteCount,skip=0):
+    # v5+ readback of byteCount bytes from the address already set on the
+    # dongle, leaving out the first skip bytes of the first word. The reads
+    # of the next unit are sent before the current one is received so the
+    # dongle streams it without waiting for a round trip, and the file is
+    # written by a BlockWriter
+    units = read_plan((skip+byteCount+1)/2)
+    if not units:
+        return
+    writer = BlockWriter(f)
+    writer.start()
+    try:
+        issue_unit(don,units[0][0])
+        pos = -skip     # output position of the unit
+        for i in range(len(units)):
+            if i+1<len(units):
+                issue_unit(don,units[i+1][0])
+            size = units[i][1]
+            buf = writer.free.get()
+            got = don.getReturnInto(memoryview(buf)[:size])
+            if got<size:
+                raise SerialPortException('Timeout')
+            writer.full.put((buf, max(-pos,0), min(size,byteCount-pos)))
+            pos = pos + size
+            if mode.v == 1:
+                print 'Got block %i'%(i+1)
+            else:
+                sys.stdout.write(".")
+                sys.stdout.flush()
+    finally:
+        writer.finish()
+
+
+def read_into(mode,don,view,skip=0):
+    # read_blocks into a writable buffer view of the whole length. Units
+    # are received right into place, only the ends that stick out of the
+    # view go through a separate buffer
+    units = read_plan((skip+len(view)+1)/2)
+    if not units:
+        return
+    issue_unit(don,units[0][0])
+    pos = -skip
+    for i in range(len(units)):
+        if i+1<len(units):
+            issue_unit(don,units[i+1][0])
+        size = units[i][1]
+        if pos >= 0 and pos+size <= len(view):
+            got = don.getReturnInto(view[pos:pos+size])
+        else:
+            buf = bytearray(size)
+            got = don.getReturnInto(memoryview(buf))
+            lo = max(-pos,0)
+            hi = min(size,len(view)-pos)
+            view[pos+lo:pos+hi] = buf[lo:hi]
+        if got<size:
+            raise SerialPortException('Timeout')
+        pos = pos + size
+        if mode.v == 1:
+            print 'Got block %i'%(i+1)
+        else:
+            sys.stdout.write(".")
+            sys.stdout.flush()
+
+
+def read_to_file(mode,don,f,byteCount,skip=0):
+    # v5+ readback into the file f from the address already set on the
+    # dongle. The file is sized up front and mapped so the data lands in it
+    # without copies, read_blocks writes it where that can't be done
+    mapped = map_output(f,byteCount)
+    if mapped==None:
+        read_blocks(mode,don,f,byteCount,skip)
+        return
+    (mapping, view) = mapped
+    read_into(mode,don,view,skip)
+    mapping.flush()
+
+
+def plan_reads(ranges, unit):
+    # group the byte (offset, length) ranges into spans, each read in one go
+    # with reads of unit bytes. A read always returns a whole unit, so a
+    # range joins the span before it when that takes no more reads than
+    # reading both apart. Returns (first byte, end byte, range indexes) of
+    # each span
+    order = range(len(ranges))
+    order.sort(lambda a, b: cmp(ranges[a][0], ranges[b][0]))
+    spans = []
+    for i in order:
+        (offset, length) = ranges[i]
+        start = offset & ~1     # reads start on a word
+        end = offset + length
+        if spans:
+            (first, last, members) = spans[-1]
+            apart = (last-first+unit-1)/unit + (end-start+unit-1)/unit
+            joined = (max(last,end)-first+unit-1)/unit
+            if joined <= apart:
+                spans[-1] = (first, max(last,end), members+[i])
+                continue
+        spans.append((start, end, [i]))
+    return spans
+
+
+def read_legacy(mode,don,address,byteCount):
+    # pre v5 readback of byteCount bytes from word address
+    don.write_command(0x00FF) #  put flash to data read mode
+    return LegacyReader(don).read(address,byteCount)
+
+
+def read_ranges(mode,don):
+    # readback of all <offset> <length> <file> sets in this session. The
+    # planner joins overlapping and nearby ranges so each span is read once
+    for (offset, length, name) in mode.ranges:
+        if offset<0 or length<0 or name=="":
+            print "Some of readback parameters missing..."
+            return 0
+        if offset+length > 4*1024*1024:
+            print "Range 0x%x+%i is outside the 4MB window"%(offset,length)
+            return 0
+    unit = 256
+    if mode.version >= 5:
+        unit = 16384    # short reads cost about a round trip in link time per 16K
+    spans = plan_reads([(offset, length) for (offset, length, name) in mode.ranges], unit)
+    print 'Reading %i ranges in %i spans'%(len(mode.ranges),len(spans))
+    for (start, end, members) in spans:
+        if mode.v == 1:
+            print 'Span 0x%06x to 0x%06x'%(start,end)
+        if mode.version >= 5:
+            data = cached_read(mode,don,start/2,end-start)
+        else:
+            data = read_legacy(mode,don,start/2,end-start)
+        for i in members:
+            (offset, length, name) = mode.ranges[i]
+            f = open_output(name)
+            f.write(data[offset-start:offset-start+length])
+            f.close()
+    print "Readback done!"
+    return 1
+
+
 def flash_read(mode,don):
+    if len(mode.ranges) > 1:
+        try:
+            ok = read_ranges(mode,don)
+        except IOError:
+            print "IO Error on file open"
+            ok = 0
+        if not ok:
+            don.write_command(0x00FF) # 0x0098  --set flash to read array mode
+            don.write_command(0xC6C5)   #clear lock bit
+            ret_buf=don.getReturn(2)    #two bytes expected to this command
+            sys.exit()
+        don.write_command(0x00FF) # 0x0098  --set flash to read array mode
+        return
     if mode.offset!=-1 and mode.length!=-1 and mode.filename!="":
         if mode.version >= 5:
             ##################### from hw ver 5 readback code ##################################################
-            blockCount = (mode.length>>17)+1 #read this many 64K word blocks
+            byteCount = mode.length
+            skip = mode.offset&1    # odd offset, the first word read has one byte too many
             mode.offset=mode.offset>>1    #make word offset
-            lastLength = mode.length&0x0001FFFF  
             mode.length= mode.length>>1   #make word length
             if mode.length < 512:                
-                print 'Reading %i bytes in single block '%(lastLength)
+                print 'Reading %i bytes'%(byteCount)
             else:
                 print 'Reading %iK '%(mode.length/512)
             don.write_command(0x00FF) #  put flash to data read mode
             try:
-                f=open(mode.filename,"wb")  #if this fails no point in reading as there is nowhere to write
+                f=open_output(mode.filename)  #if this fails no point in reading as there is nowhere to write
                 address = mode.offset    # set word address
-                don.set_address(address)
-                i=0
-                while (i<blockCount):
-                    don.issue_blk_read()  # request 64K words from current address
-                    buf=don.getReturn(65536*2) #Read all words
-                    if (i==blockCount-1):  #last block
-                        f.write(buf[:lastLength])
-                    else:
-                        f.write(buf) ## must tuncate the buffer
-                    if mode.v == 1:
-                        print 'Got block %i'%(i+1)
-                    else:
-                        sys.stdout.write(".")
-                        sys.stdout.flush()
-                    i+=1
+                if mode.shadow!=None:
+                    f.write(cached_read(mode,don,address,skip+byteCount)[skip:])
+                else:
+                    don.set_address(address)
+                    read_to_file(mode,don,f,byteCount,skip)
                 f.close()    
             except IOError:
                 print "IO Error on file open"
@@ -1235,26 +3895,28 @@ def flash_read(mode,don):
             ##################### end from hw ver 5 readback code  ############################################ 
         else:
             ##################### before hw ver 5 readback code ###############################################
+            byteCount = mode.length
+            skip = mode.offset&1    # odd offset, the first word read has one byte too many
             mode.offset=mode.offset>>1    #make word offset
             mode.length= mode.length>>1   #make word length
             print 'Reading %iK'%(mode.length/512)
             try:
-                f=open(mode.filename,"wb")
+                f=open_output(mode.filename)
                 don.write_command(0x00FF) #  put flash to data read mode
                 address = mode.offset    # set word address
-                while 1:
-                    if address/(1024*32) != (address-128)/(1024*32):  # get K bytes from words if 512
+                done = 0
+                for buf in LegacyReader(don).chunks(address,skip+byteCount):
+                    if skip:
+                        buf = buf[skip:]   # byte before the odd offset
+                        skip = 0
+                    f.write(buf)
+                    if (done+len(buf))/(1024*64) != done/(1024*64):  # every 64K bytes
                         if mode.v == 1:
-                            print 'Progress: %iK of %iK'%((address-mode.offset)/512,mode.length/512)
+                            print 'Progress: %iK of %iK'%((done+len(buf))/1024,byteCount/1024)
                         else:
                             sys.stdout.write(".")
                             sys.stdout.flush()
-                    buf=don.read_data(128,address)  # word count and byte address read 64 words to speed up
-                    f.write(buf)
-                    #print "from address:",address<<1," ", len(buf)
-                    if address+128 >= (mode.offset + mode.length):  # 2+64 estimates the end to end in right place
-                        break
-                    address = address + 128    #this is word address
+                    done = done + len(buf)
                 f.close()
                 if mode.v == 0:
                     print " "            
@@ -1277,45 +3939,43 @@ def flash_read(mode,don):
     
 
 def psram_read(mode,don):
+    if len(mode.ranges) > 1 and mode.version > 5:
+        try:
+            ok = read_ranges(mode,don)
+        except IOError:
+            print "IO Error on file open"
+            ok = 0
+        if not ok:
+            don.write_command(0xC6C5)   #clear lock bit
+            ret_buf=don.getReturn(2)    #two bytes expected to this command
+            sys.exit()
+        return
     if mode.offset!=-1 and mode.length!=-1 and mode.filename!="":
         if mode.version > 5:  #should never be smaller here
-            blockCount = (mode.length>>17)+1 #read this many 64K word blocks
+            byteCount = mode.length
+            skip = mode.offset&1    # odd offset, the first word read has one byte too many
             mode.offset=mode.offset>>1    #make word offset
-            lastLength = mode.length&0x0001FFFF  
             mode.length= mode.length>>1   #make word length
             if mode.length < 512:                
-                print 'Reading %i bytes in single block '%(lastLength)
+                print 'Reading %i bytes'%(byteCount)
                 sys.stdout.flush()
             else:
                 print 'Reading %iK'%(mode.length/512)
                 sys.stdout.flush()
             try:
-                f=open(mode.filename,"wb")  #if this fails no point in reading as there is nowhere to write
+                f=open_output(mode.filename)  #if this fails no point in reading as there is nowhere to write
                 address = mode.offset    # set word address
                 don.set_address(address)
-                i=0
-                while (i<blockCount):
-                    try:
-                        don.issue_blk_read()  # request 64K words from current address
-                        buf=don.getReturn(65536*2) #Read all words
-                    except SerialPortException:
-                        if sys.platform=='win32':
-                            print("\nExit due to driver error...")
-                            print("Please disconnect dongle and try again... \n")
-                            sys.exit()
-                        else:
-                            print("\nPlease send email to jyrit@artecdesign.ee stating your dongle version")
-                            print("disconnect the dongle and try again")
-                    if (i==blockCount-1):  #last block
-                        f.write(buf[:lastLength])
-                    else:
-                        f.write(buf) ## must tuncate the buffer
-                    if mode.v == 1:
-                        print 'Got block %i'%(i+1)
+                try:
+                    read_to_file(mode,don,f,byteCount,skip)
+                except SerialPortException:
+                    if sys.platform=='win32':
+                        print("\nExit due to driver error...")
+                        print("Please disconnect dongle and try again... \n")
                     else:
-                        sys.stdout.write(".")
-                        sys.stdout.flush()
-                    i+=1
+                        print("\nPlease send email to jyrit@artecdesign.ee stating your dongle version")
+                        print("disconnect the dongle and try again")
+                    sys.exit()
                 f.close()    
             except IOError:
                 print "IO Error on file open"
@@ -1360,11 +4020,12 @@ def flash_qry(mode,don):
 def flash_test(mode,don):
         print "FLASH TEST"
         test_status = 1
+        if mode.shadow!=None:
+            mode.shadow.drop(range(32))   # test patterns overwrite the flash
         if mode.e == 1:
             #Erase Dongle
             print "Erasing"
-            don.write_command(0x0060) # 0x0098
-            don.write_command(0x00D0) # 0x0098
+            don.clear_lock_bits()
             don.wait_on_busy()
             don.parse_status()
             endBlock = 31
@@ -1460,8 +4121,7 @@ def flash_test(mode,don):
             if mode.b == 1:
                 #Erase Dongle
                 print "Erasing"
-                don.write_command(0x0060) # 0x0098
-                don.write_command(0x00D0) # 0x0098
+                don.clear_lock_bits()
                 don.wait_on_busy()
                 don.parse_status()
                 endBlock = 31
@@ -1571,15 +4231,16 @@ def psram_test(mode,don):
 def flash_erase(mode,don):
             #Erase Dongle
             print "Erasing all"
-            don.write_command(0x0060) # 0x0098
-            don.write_command(0x00D0) # 0x0098
+            don.clear_lock_bits()
             if mode.version < 5:
                 don.wait_on_busy()
                 don.parse_status()
             endBlock = 31
             startBlock = 0
-            i=startBlock
-            while i <= endBlock:
+            eraseBlocks = blocks_to_erase(mode,don,range(startBlock,endBlock+1))
+            if mode.shadow!=None:
+                mode.shadow.drop(eraseBlocks)
+            for i in eraseBlocks:
                 if mode.v == 1:
                     print 'Erasing block %i '%(i)
                 else:
@@ -1589,7 +4250,6 @@ def flash_erase(mode,don):
                 if mode.version < 5:
                     don.wait_on_busy()
                     don.parse_status()   #do this after programming all but uneaven ending
-                i=i+1  
             if mode.v == 0: # add CRTL return to dots
                 print "" 
             if mode.version >= 5:
@@ -1597,11 +4257,15 @@ def flash_erase(mode,don):
                 don.wait_on_busy()
                 don.parse_status()   #do this after programming all but uneaven ending
             print "Erase done."            
+            busy_report(mode,don)
+            if mode.shadow!=None:
+                for i in eraseBlocks:
+                    mode.shadow.put(i,"")
             don.write_command(0x00FF) # 0x0098  --set flash to read array mode
 def flash_looptest(mode,don):
             print "Status Loop test"
             i=1024
-            startTime = time.clock()
+            startTime = don.tty.now()   # link clock, not CPU time
             while i > 0:
                 if i%128==0:
                     sys.stdout.write(".")
@@ -1610,120 +4274,133 @@ def flash_looptest(mode,don):
                 don.parse_status()   #do this after programming all but uneaven ending
                 i=i-1
             #if sys.platform=='win32':
-            endTime = (time.clock()-startTime)/1024.0
+            endTime = (don.tty.now()-startTime)/1024.0
             print "\nSystem round delay is %4f ms"%(endTime*1000.0)
+            print "Status poll p50 %.3f ms p90 %.3f ms p99 %.3f ms"%(don.stats.percentile('status',0.5)*1000.0,
+                don.stats.percentile('status',0.9)*1000.0, don.stats.percentile('status',0.99)*1000.0)
             sys.stdout.flush()    
             don.write_command(0x00FF) # 0x0098  --set flash to read array mode
             
 ################## Main program #########################
 
 
-last_ops = 0
-mode = DongleMode()
-# PARSE ARGUMENTS 
-for arg in sys.argv:
-    if len(sys.argv) == 1: # if no arguments display help
-       #usage(sys.argv[0])
-       usage("dongle.py")
-       sys.exit()        
-    if arg in ("-h","--help","/help","/h"):
-        #usage(sys.argv[0])
-        usage("dongle.py")
-        sys.exit()
-    if arg in ("-c"):
-        last_ops = sys.argv.index(arg) + 1  #if remains last set of options from here start ordered strings
-        i = sys.argv.index(arg)
-        print "Opening port: "+sys.argv[i+1]
-        mode.portname = sys.argv[i+1]   # next element after -c open port for usage
-    if arg[0]=="-" and arg[1]!="c": # if other opptions
-        # parse all options in this
-        last_ops = sys.argv.index(arg)  #if remains last set of options from here start ordered strings
-        ops = arg[1:]# get all besides the - sign
-        for op in ops:
-            if op=="q":
-                mode.q = 1
-            if op=="v":
-                mode.v = 1
-            if op=="f":
-                mode.f = 1
-            if op=="d":
-                mode.d = 1
-            if op=="r":
-                mode.r = 1
-            if op=="t":
-                mode.t = 1  
-            if op=="e":
-                mode.e = 1   
-            if op=="b":
-                mode.b = 1
-            if op=="l":
-                mode.l = 1
-            if op=="p":
-                mode.p = 0
-            if op=="P":
-                mode.p = 1
-            if op=="u":
-                mode.u = 1                     
-    else:
-        i = sys.argv.index(arg)
-        if i ==  last_ops + 1:
-            if mode.r==1:
-                mode.offset=mode.convParamStr(arg)
-            else:
-                mode.filename=arg
-        if i ==  last_ops + 2:
-            if mode.r==1:
-                mode.length=mode.convParamStr(arg)
-            else:
-                if arg.find("EOF")>-1:
-                    print "Found EOF marker"
-                    mode.eof = 1    #the file is to be written to the end of 4M area
-                    mode.address = 0
+def parse_args(argv):
+    last_ops = 0
+    mode = DongleMode()
+    # PARSE ARGUMENTS 
+    for (i, arg) in enumerate(argv):
+        if len(argv) == 1: # if no arguments display help
+           #usage(argv[0])
+           usage("dongle.py")
+           sys.exit()        
+        if arg in ("-h","--help","/help","/h"):
+            #usage(argv[0])
+            usage("dongle.py")
+            sys.exit()
+        if arg == "-c":
+            last_ops = i + 1  #if remains last set of options from here start ordered strings
+            print "Opening port: "+argv[i+1]
+            mode.portname = argv[i+1]   # next element after -c open port for usage
+        if arg == "-m":
+            last_ops = i + 1
+            mode.metrics = argv[i+1]    # command stats written here at the end
+        if arg[0]=="-" and len(arg)>1 and arg[1] not in "cm": # if other opptions, - alone is stdin/stdout
+            # parse all options in this
+            last_ops = i  #if remains last set of options from here start ordered strings
+            ops = arg[1:]# get all besides the - sign
+            for op in ops:
+                if op=="q":
+                    mode.q = 1
+                if op=="v":
+                    mode.v = 1
+                if op=="f":
+                    mode.f = 1
+                if op=="d":
+                    mode.d = 1
+                if op=="s":
+                    mode.s = 1
+                if op=="r":
+                    mode.r = 1
+                if op=="t":
+                    mode.t = 1  
+                if op=="e":
+                    mode.e = 1   
+                if op=="b":
+                    mode.b = 1
+                if op=="l":
+                    mode.l = 1
+                if op=="p":
+                    mode.p = 0
+                if op=="P":
+                    mode.p = 1
+                if op=="u":
+                    mode.u = 1                     
+                if op=="k" and mode.k == 0:
+                    mode.k = 1
+                if op=="K":
+                    mode.k = 2
+        else:
+            if i ==  last_ops + 1:
+                if mode.r==1:
+                    mode.offset=mode.convParamStr(arg)
                 else:
-                    mode.address=mode.convParamStr(arg)
+                    mode.filename=arg
+            if i ==  last_ops + 2:
+                if mode.r==1:
+                    mode.length=mode.convParamStr(arg)
+                else:
+                    if arg.find("EOF")>-1:
+                        print "Found EOF marker"
+                        mode.eof = 1    #the file is to be written to the end of 4M area
+                        mode.address = 0
+                    else:
+                        mode.address=mode.convParamStr(arg)
                 
-        if i ==  last_ops + 3:
-            if mode.r==1:
-                mode.filename=arg
-            else:
-                print "Too many parameters provided"
-                sys.exit()
-        if i >  last_ops + 3:
-             print "Too many parameters provided"
-             sys.exit()  
-
-# END PARSE ARGUMENTS             
-             
-if mode.portname=="":
-    print "No port name given see -h for help"
-    sys.exit()    
-else:
-    # test PC speed to find sutable delay for linux driver
-    # to get 250 us 
-    mytime = time.clock()
-    n = 0
-    while (n < 100000):
-	n += 1;
-    k10Time = time.clock() - mytime   # time per 10000 while cycles
-    wait = k10Time/100000.0     # time per while cycle
-    wait = (0.00025/wait) * 1.20   # count for 250us + safe margin
-    # ok done
+            if i ==  last_ops + 3:
+                if mode.r==1:
+                    mode.filename=arg
+                else:
+                    print "Too many parameters provided"
+                    sys.exit()
+            if i >  last_ops + 3:
+                if mode.r==1:
+                    # more <offset> <length> <file> sets read in the same session
+                    field = (i - last_ops - 1) % 3
+                    if field == 0:
+                        mode.ranges.append([mode.convParamStr(arg), -1, ""])
+                    elif field == 1:
+                        mode.ranges[-1][1] = mode.convParamStr(arg)
+                    else:
+                        mode.ranges[-1][2] = arg
+                else:
+                    print "Too many parameters provided"
+                    sys.exit()  
+
+    # END PARSE ARGUMENTS             
+    if mode.r==1:
+        mode.ranges.insert(0, [mode.offset, mode.length, mode.filename])
+    return mode
+
+
+def open_dongle(mode, transport=None):
+    """Open the port named in mode (or use the given DongleTransport), do the
+    handshake and read HW version, PCB version and memory region into mode.
+    Returns the Dongle with the memory ready for use"""
     reopened = 0
     
     
     if sys.platform=='win32':
-        don  = Dongle(mode.portname,256000,6000)
+        don  = Dongle(mode.portname,256000,6000,transport)
     elif sys.platform=='linux2':
-        don  = Dongle(mode.portname,230400,6000)
+        don  = Dongle(mode.portname,230400,6000,transport)
         #don.tty.cts()
     elif sys.platform=='darwin':
-        don  = Dongle(mode.portname,230400,6000)
+        don  = Dongle(mode.portname,230400,6000,transport)
         #don.tty.cts()
     else:
         sys.exit('Sorry, no implementation for this platform yet')
     
     
-    don.tty.wait = wait   
     while 1:
         #don.write_command(0x0050)    #FLASH command clear status register  
         don.write_command(0x00C5)            #send dongle check internal command
@@ -1736,16 +4413,15 @@ else:
         reopened = reopened + 1
         # reopen and do new cycle
         if sys.platform=='win32':
-            don  = Dongle(mode.portname,256000,6000)
+            don  = Dongle(mode.portname,256000,6000,transport)
         elif sys.platform=='linux2':
-            don  = Dongle(mode.portname,230400,6000)
+            don  = Dongle(mode.portname,230400,6000,transport)
             #self.tty.cts()
         elif sys.platform=='darwin':
-            don  = Dongle(mode.portname,230400,6000)
+            don  = Dongle(mode.portname,230400,6000,transport)
             #self.tty.cts()
         else:
             sys.exit('Sorry, no implementation for this platform yet')
-        don.tty.wait = wait   
 
     buf=don.getReturn(2)  # two bytes expected to this command
     if ord(buf[1])==0x32 and  ord(buf[0])==0x10:
@@ -1778,6 +4454,7 @@ else:
             buf_dc = don.getReturn(2)  # two bytes expected to this command                
         if mode.u == 1:
             don.write_command(0xC2C5)  # force USB prog mode signals to conf memory  
+            don.flush_commands()
             #buf_dc = don.getReturn(2)  # two bytes expected to this command                
             sys.exit()
         don.write_command(0x02C5)  #try getting PCB ver (works since 06 before that returns 0x3210)
@@ -1785,6 +4462,7 @@ else:
         i_temp = 0
         i_temp = (ord(buf[1])<<8)|ord(buf[0])
         print 'Dongle PCB version code is AD 67075%05i'%( i_temp )
+        mode.pcb = i_temp
         don.write_command(0x03C5)            #try getting mode switch setting (works since 06 before that returns 0x3210)
         buf=don.getReturn(2)  # two bytes expected to this command
         mode_reg = ord(buf[0])
@@ -1804,59 +4482,106 @@ else:
         don.write_command(0x0050)    #FLASH command clear status register
         don.write_command(0x00FF) # 0x0098  --set flash to read array mode
         #Flash mode init
+    return don
 
-#Lock LPC out from memory interface        
-don.write_command(0xC5C5)   #set lock bit up
-ret_buf=don.getReturn(2)    #two bytes expected to this command
 
-if mode.q == 1:   # perform a query from dongle  
-    if mode.region<4:
-        flash_qry(mode,don)
+def lock_dongle(don):
+    #Lock LPC out from memory interface        
+    don.write_command(0xC5C5)   #set lock bit up
+    ret_buf=don.getReturn(2)    #two bytes expected to this command
+
+
+def unlock_dongle(don):
+    #Unlock memory interface        
+    don.write_command(0xC6C5)   #clear lock bit
+    ret_buf=don.getReturn(2)    #two bytes expected to this command
+
+
+def write_metrics(mode,don):
+    # -m file: the command stats of the session, Prometheus text for a name
+    # ending .prom so a textfile collector can pick it up, JSON otherwise.
+    # Written under a temporary name and renamed so it is never seen half done
+    labels = {'port': mode.portname, 'hw_version': '%02x'%(mode.version)}
+    if mode.metrics.endswith(".prom"):
+        text = don.stats.prometheus(labels)
     else:
-        print "Query only supported on flash regions (to change region turn the Mode switch):"
-        print "FLASH regions are regions from 0 to 3"    
+        report = don.stats.summary()
+        report.update(labels)
+        text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    try:
+        f = open(mode.metrics+".tmp", "w")
+        f.write(text)
+        f.close()
+        if sys.platform=='win32' and os.path.exists(mode.metrics):
+            os.remove(mode.metrics)
+        os.rename(mode.metrics+".tmp", mode.metrics)
+    except (IOError, OSError), e:
+        print "Unable to write metrics:",e
+
+
+def main(argv):
+    mode = parse_args(argv)
+    if mode.portname=="":
+        print "No port name given see -h for help"
+        sys.exit()    
+    don = open_dongle(mode)
+    try:   # the stats are written also when an operation exits
+        lock_dongle(don)
+        if mode.s == 1:
+            mode.shadow = open_shadow(mode)
+
+        if mode.q == 1:   # perform a query from dongle  
+            if mode.region<4:
+                flash_qry(mode,don)
+            else:
+                print "Query only supported on flash regions (to change region turn the Mode switch):"
+                print "FLASH regions are regions from 0 to 3"    
     
     
-if mode.filename!="" and mode.address!=-1:   #Dongle write command given
-    if mode.region<4:
-        print "Flash write called"
-        flash_write(mode,don)
-    else:
-        print "PSRAM write called"
-        psram_write(mode,don)
+        if mode.filename!="" and mode.address!=-1:   #Dongle write command given
+            if mode.region<4:
+                print "Flash write called"
+                flash_write(mode,don)
+            else:
+                print "PSRAM write called"
+                psram_write(mode,don)
     
-if mode.r == 1:   # perform a readback
-    if mode.region<4:
-        print "Flash read called"
-        flash_read(mode,don)
-    else:
-        print "PSRAM read called"
-        psram_read(mode,don)    
+        if mode.r == 1:   # perform a readback
+            if mode.region<4:
+                print "Flash read called"
+                flash_read(mode,don)
+            else:
+                print "PSRAM read called"
+                psram_read(mode,don)    
     
-if mode.t == 1:   # perform dongle test
-    if mode.region<4:
-        flash_test(mode,don)
-    else:
-        psram_test(mode,don)
-if mode.e == 1:   # perform dongle erase
-    if mode.region<4:
-        flash_erase(mode,don)
-    else:
-        print "Erase is supported on flash regions (to change region turn the Mode switch):"
-        print "FLASH regions are regions from 0 to 3"    
+        if mode.t == 1:   # perform dongle test
+            if mode.region<4:
+                flash_test(mode,don)
+            else:
+                psram_test(mode,don)
+        if mode.e == 1:   # perform dongle erase
+            if mode.region<4:
+                flash_erase(mode,don)
+            else:
+                print "Erase is supported on flash regions (to change region turn the Mode switch):"
+                print "FLASH regions are regions from 0 to 3"    
         
-if mode.l == 1:   # perform dongle test  
-    if mode.region<4:
-        flash_looptest(mode,don)
-    else:
-        print "Looptest is supported on flash regions (to change region turn the Mode switch):"
-        print "FLASH regions are regions from 0 to 3"            
-    
-##########################################################
+        if mode.l == 1:   # perform dongle test  
+            if mode.region<4:
+                flash_looptest(mode,don)
+            else:
+                print "Looptest is supported on flash regions (to change region turn the Mode switch):"
+                print "FLASH regions are regions from 0 to 3"
+        
+        ##########################################################
+        unlock_dongle(don)
+    finally:
+        if mode.metrics!="":
+            write_metrics(mode,don)
+    sys.exit()
+
 
-#Unlock memory interface        
-don.write_command(0xC6C5)   #clear lock bit
-ret_buf=don.getReturn(2)    #two bytes expected to this command
-sys.exit()
+if __name__=='__main__':
+    main(sys.argv)
 
 
@@ -0,0 +1,612 @@
+#! /usr/bin/python
+# -*- coding: ISO-8859-1 -*-
+
+##########################################################################
+# LPC Dongle programming software event loop API
+#
+# Copyright (C) 2008 Artec Design
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+##########################################################################
+
+#-------------------------------------------------------------------------
+# Project:   LPC Dongle programming software
+# Name:      dongle_async.py
+# Purpose:   Drive many dongles from one process. DongleSession methods
+#            are generator coroutines run by a DongleLoop, which waits on
+#            all ports at once with poll/select on non-blocking descriptors
+#-------------------------------------------------------------------------
+#
+# Example, reads the first block of two dongles at the same time:
+#
+#   def readback(session):
+#       yield session.handshake()
+#       yield session.lock()
+#       data = yield session.read_block(0)
+#       yield session.unlock()
+#       yield Return(data)
+#
+#   loop = DongleLoop()
+#   a = loop.spawn(readback(DongleSession("/dev/ttyUSB0")))
+#   b = loop.spawn(readback(DongleSession("/dev/ttyUSB1")))
+#   loop.run()
+#   print len(a.result()), len(b.result())
+#
+# A coroutine yields one of:
+#   a generator      runs it as a sub coroutine, the yield gives its result
+#   Return(value)    ends the coroutine with value
+#   Sleep(session, seconds), Read(session, byteCount), Drain(session)
+#                    the waits the DongleSession methods are built from
+# Errors (SerialPortException on timeouts and flash errors) are raised at
+# the yield in the calling coroutine.
+
+import os
+import sys
+import select
+import errno
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import dongle
+from dongle import SerialPortException, DongleTransport, monotonic_time, FRAME_BYTES
+
+if sys.platform != 'win32':
+    import fcntl
+
+READABLE = 1
+WRITABLE = 2
+
+
+class Return:
+    """Yielded by a coroutine to end with a value"""
+    def __init__(self, value=None):
+        self.value = value
+
+
+class Sleep:
+    """Wait seconds on the link clock of session"""
+    def __init__(self, session, seconds):
+        self.session = session
+        self.seconds = seconds
+
+
+class Read:
+    """Wait for byteCount reply bytes from session and read them, gives the data"""
+    def __init__(self, session, byteCount, timeout=None):
+        self.session = session
+        self.byteCount = byteCount
+        self.timeout = timeout
+        self.chunks = []        # reply bytes that have arrived so far
+        self.got = 0
+
+
+class Drain:
+    """Wait until everything queued for session has been written to the port"""
+    def __init__(self, session):
+        self.session = session
+
+
+class SessionLink(DongleTransport):
+    """Transport between a Dongle and the real port that never blocks on
+    writes: they are queued and DongleLoop hands them to the port when its
+    descriptor is writable. Reads go to the port, the loop only reads what
+    has already arrived"""
+
+    def __init__(self, tty):
+        self.tty = tty
+        self.out = []           # queued writes
+        self.outview = None     # unwritten rest of the write in progress
+        self.fd = None
+        if sys.platform != 'win32':
+            try:
+                self.fd = tty.fileno()
+            except AttributeError:
+                self.fd = None
+        if self.fd != None:
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # without a descriptor to wait on (Windows) the port is polled, only
+        # the emulator on simulated time moves its clock by blocking
+        self.polled = self.fd == None and getattr(tty, 'realtime', 1)
+
+    def write(self, s):
+        self.out.append(s)
+        return len(s)
+
+    def pending(self):
+        return self.outview != None or len(self.out) > 0
+
+    def pump(self):
+        """Write as much of the queued output as the port takes now"""
+        if self.fd == None:
+            if self.out:
+                self.tty.write("".join(self.out))
+                self.out = []
+            return
+        while self.pending():
+            if self.outview == None:
+                self.outview = memoryview("".join(self.out))
+                self.out = []
+            try:
+                n = os.write(self.fd, self.outview)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise SerialPortException('Write failed: ' + str(e))
+            if n < len(self.outview):
+                self.outview = self.outview[n:]
+            else:
+                self.outview = None
+
+    def read(self, num=1):
+        return self.tty.read(num)
+
+    def readview(self, num):
+        return self.tty.readview(num)
+
+    def inWaiting(self):
+        return self.tty.inWaiting()
+
+    def outWaiting(self):
+        return self.tty.outWaiting()
+
+    def waitInput(self, byteCount, timeout=None):
+        return self.tty.waitInput(byteCount, timeout)
+
+    def flush(self):
+        self.out = []
+        self.outview = None
+        self.tty.flush()
+
+    def now(self):
+        return self.tty.now()
+
+    def sleep(self, seconds):
+        self.tty.sleep(seconds)
+
+
+class DongleSession:
+    """One dongle driven from a DongleLoop. Uses the Dongle class for the
+    command encoding, the generator methods replace its blocking waits.
+    Opening the port itself still blocks (retries while the device appears)"""
+
+    def __init__(self, name, timeout=6000, transport=None):
+        if transport == None:
+            if sys.platform == 'win32':
+                baud = 256000
+            else:
+                baud = 230400
+            transport = dongle.open_transport(name, baud, timeout)
+        self.name = name
+        self.timeout = timeout/1000.0    # reply timeout in seconds
+        self.link = SessionLink(transport)
+        self.don = dongle.Dongle(name, 0, timeout, self.link)
+        self.mode = dongle.DongleMode()
+        self.mode.portname = name
+        self.don.mode = self.mode
+        self.pcb = None
+
+    def flush(self):
+        self.don.flush_commands()
+
+    def command(self, word, replyBytes=0):
+        """Send one command word, gives the reply if replyBytes is set"""
+        self.don.write_command(word)
+        self.flush()
+        if replyBytes:
+            buf = yield Read(self, replyBytes)
+            yield Return(buf)
+
+    def handshake(self, lpc_present=0):
+        """Check the dongle answers and read HW version, PCB version and the
+        memory region into self.mode. Gives self.mode"""
+        tries = 0
+        while 1:
+            try:
+                buf = yield self.__check()
+                break
+            except SerialPortException:
+                tries += 1
+                if tries > 3:
+                    raise SerialPortException('Dongle connected, but does not communicate')
+                self.link.flush()
+        if buf != "\x10\x32":
+            raise SerialPortException('Dongle returned on open: %02x %02x' % (ord(buf[1]), ord(buf[0])))
+        buf = yield self.command(0x01C5, 2)    # HW version, since 05 before that returns 0x3210
+        if ord(buf[1]) == 0x86 and ord(buf[0]) > 0x04:
+            self.mode.version = ord(buf[0])
+        if self.mode.version > 0x19:   # Dongle II versions
+            if lpc_present:
+                yield self.command(0xC4C5, 2)
+            else:
+                yield self.command(0xC3C5, 2)
+            buf = yield self.command(0x02C5, 2)
+            self.pcb = (ord(buf[1]) << 8) | ord(buf[0])
+            buf = yield self.command(0x03C5, 2)
+            if ord(buf[1]) == 0x00:
+                self.mode.region = ord(buf[0])
+        if self.mode.region <= 3:
+            self.don.write_command(0x0050)    # clear status register
+            self.don.write_command(0x00FF)    # read array mode
+            self.flush()
+        yield Return(self.mode)
+
+    def __check(self):
+        self.don.write_command(0x00C5)
+        self.flush()
+        buf = yield Read(self, 2, 0.5)
+        yield Return(buf)
+
+    def lock(self):
+        """Lock LPC out from the memory interface"""
+        return self.command(0xC5C5, 2)
+
+    def unlock(self):
+        return self.command(0xC6C5, 2)
+
+    def read_status(self):
+        """Gives the flash status register"""
+        self.don.write_command(0x0070)
+        self.don.write_command(0x01CD)
+        self.flush()
+        buf = yield Read(self, 2)
+        yield Return(ord(buf[0]))
+
+    def wait_ready(self):
+        """Wait for the flash like Dongle.wait_on_busy: sleep through the
+        expected time of the started work, then poll the status with a
+        doubling gap. Raises on error bits and when the flash is still busy
+        at the worst case time. Gives the status register value"""
+        timer = self.don.timer
+        start = self.link.now()
+        (done, deadline, longest) = timer.plan()
+        if done > start:
+            yield Sleep(self, done - start)
+        gap = timer.first_gap
+        while 1:
+            status = yield self.read_status()
+            if status & 0x80:
+                break
+            now = self.link.now()
+            if now >= deadline:
+                raise SerialPortException('Flash still busy after %.1fs' % (now - start))
+            yield Sleep(self, min(gap, deadline - now))
+            gap = min(gap*2, longest)
+        for (kind, block, seconds) in timer.finished():
+            if kind == 'erase':
+                self.don.stats.time('erase', seconds)
+        errors = dongle.status_errors(status)
+        if errors:
+            raise SerialPortException(", ".join(errors))
+        yield Return(status)
+
+    def read_block(self, address, wordCount=65536):
+        """Read wordCount words (at most one 64K word block) from word address.
+        Gives the data as a string"""
+        if wordCount > 255:
+            count = 0       # whole 64K word block, the count is 8 bits
+        else:
+            count = wordCount
+        if self.mode.region <= 3:
+            self.don.write_command(0x00FF)    # flash to read array mode
+        if self.mode.version < 5:
+            buf = yield self.read_legacy(address, wordCount)
+            yield Return(buf)
+        self.don.set_address(address)
+        self.don.write_command((count << 8) | 0xCD)
+        self.flush()
+        buf = yield Read(self, (count or 65536)*2)
+        yield Return(buf[:wordCount*2])
+
+    def read_legacy(self, address, wordCount):
+        # no block read before v5, reads of 128 words each with its own
+        # address like LegacyReader, as many queued as fit in the FT245 FIFO
+        step = dongle.LegacyReader.words
+        depth = dongle.LegacyReader.fifo/8
+        chunks = []
+        asked = got = 0
+        while got < wordCount:
+            while asked < wordCount and asked - got < depth*step:
+                count = min(step, wordCount - asked)
+                self.don.set_address(address + asked)
+                self.don.write_command((count << 8) | 0xCD)
+                asked += count
+            self.flush()
+            count = min(step, wordCount - got)
+            buf = yield Read(self, count*2)
+            chunks.append(buf)
+            got += count
+        yield Return("".join(chunks))
+
+    def erase_block(self, blockNo):
+        """Erase one 64K word flash block and wait for it to complete"""
+        self.don.erase_block(blockNo)
+        yield self.wait_ready()
+
+    def clear_lock_bits(self):
+        """Clear the block lock bits, locked blocks don't erase or program"""
+        self.don.clear_lock_bits()
+        self.flush()
+        yield self.wait_ready()
+
+    def erase(self, startBlock=0, endBlock=31):
+        yield self.clear_lock_bits()
+        block = startBlock
+        while block <= endBlock:
+            yield self.erase_block(block)
+            block += 1
+        self.don.write_command(0x00FF)
+        self.flush()
+
+    def flash_write(self, address, data):
+        """Program data into erased flash from word address with buffer
+        writes and wait for the flash to finish"""
+        return self.write_frames(encode_flash_write(address, data))
+
+    def write_frames(self, chunks):
+        """Send buffer write frames made by encode_flash_write and wait for
+        the flash to finish. The chunks can be shared between sessions"""
+        for chunk in chunks:
+            if self.mode.version < 5:
+                # no flow control, each frame must reach the dongle and complete
+                for i in range(0, len(chunk), FRAME_BYTES):
+                    self.don.write_raw(chunk[i:i+FRAME_BYTES])
+                    yield Drain(self)
+                    yield Sleep(self, self.don.pacer.frame_gap)
+            else:
+                self.don.write_raw(chunk)
+                self.don.timer.streamed = 1
+                yield Drain(self)   # bound the queued output
+        yield self.wait_ready()
+        self.don.write_command(0x00FF)
+        self.flush()
+
+    def psram_write(self, address, data):
+        """Write data to PSRAM from word address (Dongle II)"""
+        if self.mode.version <= 0x19:
+            raise SerialPortException('PSRAM write needs Dongle II')
+        offset = 0
+        while offset < len(data):
+            self.don.buffer_write_ram(address + offset/2, data[offset:offset+65536*2])
+            offset += 65536*2
+            yield Drain(self)
+
+
+def encode_flash_write(address, data, chunkBytes=65536):
+    """Encode the buffer write frames programming data from word address
+    into erased flash, returns them as strings each covering chunkBytes of
+    data. Frames of all 0xFF are left out"""
+    chunks = []
+    for offset in range(0, len(data), chunkBytes):
+        chunks.append(dongle.encode_frames(address + offset/2, data[offset:offset+chunkBytes], 1))
+    return chunks
+
+
+class Task:
+    """A coroutine running in a DongleLoop"""
+
+    def __init__(self, coroutine, name=None):
+        self.stack = [coroutine]
+        self.name = name
+        self.wait = None
+        self.deadline = None
+        self.done = 0
+        self.value = None
+        self.error = None
+
+    def result(self):
+        """Value the coroutine ended with, raises its exception if it failed"""
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+class DongleLoop:
+    """Runs coroutines, waiting on all their ports with one poll/select call.
+    Transports without a descriptor (windows ports) are polled every
+    poll_tick, the emulator on simulated time is waited on directly, which
+    costs nothing"""
+
+    # seconds between polls of a port without a descriptor
+    poll_tick = 0.001
+
+    def __init__(self):
+        self.tasks = []
+
+    def spawn(self, coroutine, name=None):
+        task = Task(coroutine, name)
+        self.tasks.append(task)
+        self.__step(task, None, None)
+        return task
+
+    def run(self):
+        """Run until all tasks are done, returns the tasks"""
+        while 1:
+            waiting = [t for t in self.tasks if not t.done]
+            if not waiting:
+                break
+            progress = 0
+            for task in waiting:
+                if self.__check(task):
+                    progress = 1
+            if progress:
+                continue
+            self.__poll(waiting)
+        tasks = self.tasks
+        self.tasks = []
+        return tasks
+
+    def __step(self, task, value, error):
+        """Resume task until it yields a wait or ends"""
+        while 1:
+            gen = task.stack[-1]
+            try:
+                if error:
+                    yielded = gen.throw(error[0], error[1], error[2])
+                else:
+                    yielded = gen.send(value)
+            except StopIteration:
+                yielded = Return(None)
+            except Exception:
+                error = sys.exc_info()
+                task.stack.pop()
+                if not task.stack:
+                    task.error = error
+                    task.done = 1
+                    return
+                continue
+            value = None
+            error = None
+            if isinstance(yielded, Return):
+                gen.close()
+                task.stack.pop()
+                value = yielded.value
+                if not task.stack:
+                    task.value = value
+                    task.done = 1
+                    return
+            elif hasattr(yielded, 'send') and hasattr(yielded, 'throw'):
+                task.stack.append(yielded)
+            else:
+                self.__start_wait(task, yielded)
+                return
+
+    def __start_wait(self, task, wait):
+        task.wait = wait
+        task.deadline = None
+        link = wait.session.link
+        if isinstance(wait, Sleep):
+            if link.fd == None and not link.polled:
+                link.pump()
+                link.sleep(wait.seconds)    # link clock, simulated for the emulator
+            else:
+                task.deadline = monotonic_time() + wait.seconds
+        elif isinstance(wait, Read):
+            self.__read_deadline(task)
+        elif not isinstance(wait, Drain):
+            raise TypeError('Unknown wait %r' % (wait,))
+
+    def __read_deadline(self, task):
+        timeout = task.wait.timeout
+        if timeout == None:
+            timeout = task.wait.session.timeout
+        task.deadline = monotonic_time() + timeout  # counts from the last received data
+
+    def __check(self, task):
+        """Resume task if its wait is over, returns 1 if it was resumed"""
+        wait = task.wait
+        link = wait.session.link
+        if link.pending():
+            link.pump()
+        if isinstance(wait, Drain):
+            if link.pending():
+                return 0
+            self.__resume(task, None, None)
+        elif isinstance(wait, Sleep):
+            if task.deadline != None and monotonic_time() < task.deadline:
+                return 0
+            self.__resume(task, None, None)
+        else:
+            if link.pending():
+                return self.__check_timeout(task)
+            need = wait.byteCount - wait.got
+            if link.fd == None and not link.polled:
+                left = max(task.deadline - monotonic_time(), 0.0)
+                waiting = link.waitInput(need, left)
+                if waiting < need:
+                    return self.__check_timeout(task)
+            else:
+                # take whatever has arrived, poll wakes again for the rest
+                waiting = min(link.inWaiting(), need)
+                if waiting == 0:
+                    return self.__check_timeout(task)
+            try:
+                wait.chunks.append(link.read(min(waiting, need)))
+            except SerialPortException:
+                self.__resume(task, None, sys.exc_info())
+                return 1
+            wait.got += len(wait.chunks[-1])
+            if wait.got < wait.byteCount:
+                self.__read_deadline(task)
+                return 0
+            if wait.byteCount <= wait.session.don.pacer.short_reply:
+                wait.session.don.pacer.received()
+            self.__resume(task, "".join(wait.chunks), None)
+        return 1
+
+    def __check_timeout(self, task):
+        link = task.wait.session.link
+        if monotonic_time() < task.deadline and (link.fd != None or link.polled):
+            return 0
+        try:
+            raise SerialPortException('Timeout')
+        except SerialPortException:
+            self.__resume(task, None, sys.exc_info())
+        return 1
+
+    def __resume(self, task, value, error):
+        task.wait = None
+        self.__step(task, value, error)
+
+    def __poll(self, waiting):
+        """Sleep until a port is readable or writable or a deadline passes"""
+        events = {}
+        deadline = None
+        for task in waiting:
+            link = task.wait.session.link
+            if task.deadline != None and (deadline == None or task.deadline < deadline):
+                deadline = task.deadline
+            if link.polled and isinstance(task.wait, Read):
+                tick = monotonic_time() + self.poll_tick
+                if deadline == None or tick < deadline:
+                    deadline = tick
+            if link.fd == None:
+                continue
+            mask = events.get(link.fd, 0)
+            if link.pending():
+                mask |= WRITABLE
+            if isinstance(task.wait, Read):
+                mask |= READABLE
+            events[link.fd] = mask
+        if deadline == None:
+            left = None
+        else:
+            left = max(deadline - monotonic_time(), 0.0)
+        if not events:
+            if left:
+                DongleTransport().sleep(left)
+            return
+        if sys.platform == 'linux2':
+            p = select.poll()
+            for (fd, mask) in events.items():
+                flags = 0
+                if mask & READABLE:
+                    flags |= select.POLLIN | select.POLLPRI
+                if mask & WRITABLE:
+                    flags |= select.POLLOUT
+                p.register(fd, flags)
+            if left == None:
+                p.poll()
+            else:
+                p.poll(int(left*1000.0 + 0.999))
+        else:
+            rlist = [fd for (fd, mask) in events.items() if mask & READABLE]
+            wlist = [fd for (fd, mask) in events.items() if mask & WRITABLE]
+            select.select(rlist, wlist, [], left)
+        # a long reply arrives in many small pieces, let them collect
+        # instead of waking for every one
+        for task in waiting:
+            if isinstance(task.wait, Read) and task.wait.got > 0:
+                DongleTransport().sleep(0.0002)
+                break
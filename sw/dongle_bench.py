@@ -0,0 +1,287 @@
+#! /usr/bin/python
+# -*- coding: ISO-8859-1 -*-
+
+##########################################################################
+# LPC Dongle programming software benchmark
+#
+# Copyright (C) 2008 Artec Design
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+##########################################################################
+
+#-------------------------------------------------------------------------
+# Project:   LPC Dongle programming software
+# Name:      dongle_bench.py
+# Purpose:   Throughput benchmark of dongle.py operations against the
+#            built in dongle emulator, with JSON baselines to catch
+#            regressions
+#-------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import getopt
+import hashlib
+import json
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import dongle
+
+OPERATIONS = ('flash_write', 'flash_read', 'psram_write', 'psram_read', 'flash_erase')
+
+# metric name, 1 if bigger is better
+METRICS = (('mb_s', 1), ('link_s', 0), ('round_trips', 0), ('syscalls', 0), ('cpu_s', 0))
+CPU_NOISE = 0.05    # CPU time differences below this many seconds are noise
+
+
+def usage(s):
+    print "Artec USB Dongle dongle.py benchmark"
+    print "Usage: ",s," [-j] [-s <size>] [-o <ops>] [-l <link>] [-w <file>] [-b <file>]"
+    print "Options:"
+    print " -s <size>       Image size used for reads and writes. Default 1M"
+    print "                 use M for MegaBytes, K for KiloBytes, none for bytes"
+    print " -o <ops>        Comma separated operations to run. Default all of"
+    print "                 "+",".join(OPERATIONS)
+    print " -l <link>       Emulator and link model as key=value,... Example:"
+    print "                 version=0x20,bandwidth=1e6,latency_timer=0.016,erase_time=1.0"
+    print " -w <file>       Save the results as JSON baseline"
+    print " -b <file>       Compare against JSON baseline, exit status 1 on regression"
+    print " -t <percent>    Allowed regression of link metrics. Default 10"
+    print " -T <percent>    Allowed regression of host CPU time. Default 50"
+    print " -j              Print the results as JSON"
+
+
+class NullOutput:
+    """Swallows the progress output of the dongle.py operations"""
+    def write(self, s):
+        pass
+    def flush(self):
+        pass
+
+
+def cpu_time():
+    """Host CPU time used by this process"""
+    if sys.platform=='win32':
+        t = os.times()
+        return t[0] + t[1]
+    return time.clock()
+
+
+def make_image(size):
+    """Deterministic pseudo random test image"""
+    blocks = []
+    i = 0
+    while len(blocks)*16 < size:
+        blocks.append(hashlib.md5(str(i)).digest())
+        i += 1
+    return "".join(blocks)[:size]
+
+
+def run_operation(name, size, link, workdir):
+    """Run one operation on a fresh emulator, returns its metrics"""
+    spec = "emu:" + link
+    if name.startswith("psram") and link.find("region") == -1:
+        spec = spec + ",region=4"
+    emu = dongle.DongleEmulator.from_name(spec)
+    image = make_image(size)
+    imageFile = os.path.join(workdir, "image.bin")
+    readFile = os.path.join(workdir, "read.bin")
+    f = open(imageFile, "wb")
+    f.write(image)
+    f.close()
+    if name == "flash_read":
+        emu.flash.mem[0:size] = image
+    elif name == "psram_read":
+        emu.psram[0:size] = image
+
+    stdout = sys.stdout
+    sys.stdout = NullOutput()
+    try:
+        mode = dongle.DongleMode()
+        mode.portname = "emu"
+        don = dongle.open_dongle(mode, emu)
+        dongle.lock_dongle(don)
+        if name.endswith("write"):
+            mode.filename = imageFile
+            mode.address = 0
+        elif name.endswith("read"):
+            mode.filename = readFile
+            mode.offset = 0
+            mode.length = size
+        t0 = emu.now()
+        calls0 = emu.writes + emu.reads
+        trips0 = emu.round_trips
+        cpu0 = cpu_time()
+        if name == "flash_write":
+            dongle.flash_write(mode, don)
+        elif name == "psram_write":
+            dongle.psram_write(mode, don)
+        elif name == "flash_read":
+            dongle.flash_read(mode, don)
+        elif name == "psram_read":
+            dongle.psram_read(mode, don)
+        elif name == "flash_erase":
+            dongle.flash_erase(mode, don)
+        don.flush_commands()
+        cpu1 = cpu_time()
+        emu.settle()
+        link_s = emu.now() - t0
+        dongle.unlock_dongle(don)
+    finally:
+        sys.stdout = stdout
+
+    ok = 1
+    if name == "flash_write":
+        ok = str(emu.flash.mem[0:size]) == image
+    elif name == "psram_write":
+        ok = str(emu.psram[0:size]) == image
+    elif name.endswith("read"):
+        ok = open(readFile, "rb").read() == image
+    elif name == "flash_erase":
+        ok = emu.flash.mem == bytearray('\xff'*emu.size)
+        size = emu.size
+    result = {}
+    result['bytes'] = size
+    result['link_s'] = link_s
+    if link_s > 0:
+        result['mb_s'] = size/link_s/(1024*1024)
+    else:
+        result['mb_s'] = 0.0
+    result['round_trips'] = emu.round_trips - trips0
+    result['syscalls'] = emu.writes + emu.reads - calls0
+    result['cpu_s'] = cpu1 - cpu0
+    result['ok'] = bool(ok)
+    return result
+
+
+def compare(results, baseline, threshold, cpuThreshold):
+    """Print regressions against baseline, returns their count"""
+    regressions = 0
+    if baseline.get('size') != results['size'] or baseline.get('link') != results['link']:
+        print "Warning: baseline was taken with size %s link '%s'"%(baseline.get('size'), baseline.get('link'))
+    for name in results['operations'].keys():
+        if not baseline['operations'].has_key(name):
+            continue
+        new = results['operations'][name]
+        old = baseline['operations'][name]
+        for (metric, bigger) in METRICS:
+            if not old.has_key(metric):
+                continue
+            limit = threshold
+            if metric == 'cpu_s':
+                limit = cpuThreshold
+            if old[metric] == 0:
+                continue
+            if metric == 'cpu_s' and new[metric] - old[metric] < CPU_NOISE:
+                continue
+            change = (new[metric] - old[metric])*100.0/old[metric]
+            if bigger:
+                change = -change
+            if change > limit:
+                print "REGRESSION %-12s %-12s %12.4f -> %12.4f (%+.1f%%)"%(name, metric, old[metric], new[metric], change)
+                regressions += 1
+    return regressions
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], "hjs:o:l:w:b:t:T:")
+    except getopt.GetoptError, e:
+        print e
+        usage("dongle_bench.py")
+        sys.exit(2)
+    size = 1024*1024
+    ops = OPERATIONS
+    link = ""
+    saveFile = None
+    baseFile = None
+    threshold = 10.0
+    cpuThreshold = 50.0
+    asJson = 0
+    for (o, a) in opts:
+        if o == "-h":
+            usage("dongle_bench.py")
+            sys.exit()
+        elif o == "-s":
+            size = dongle.DongleMode().convParamStr(a)
+        elif o == "-o":
+            ops = a.split(",")
+        elif o == "-l":
+            link = a
+        elif o == "-w":
+            saveFile = a
+        elif o == "-b":
+            baseFile = a
+        elif o == "-t":
+            threshold = float(a)
+        elif o == "-T":
+            cpuThreshold = float(a)
+        elif o == "-j":
+            asJson = 1
+    for name in ops:
+        if name not in OPERATIONS:
+            print "Unknown operation",name
+            sys.exit(2)
+
+    results = {'size': size, 'link': link, 'operations': {}}
+    workdir = tempfile.mkdtemp()
+    failed = 0
+    try:
+        for name in ops:
+            try:
+                r = run_operation(name, size, link, workdir)
+            except SystemExit:
+                print "%-12s exited with an error"%(name)
+                failed += 1
+                continue
+            results['operations'][name] = r
+            if not r['ok']:
+                failed += 1
+    finally:
+        shutil.rmtree(workdir)
+
+    if asJson:
+        print json.dumps(results, indent=2, sort_keys=True)
+    else:
+        print "%-12s %10s %10s %8s %8s %8s %s"%("operation","MB/s","link s","rtrips","calls","cpu s","")
+        for name in ops:
+            if not results['operations'].has_key(name):
+                continue
+            r = results['operations'][name]
+            status = ""
+            if not r['ok']:
+                status = "DATA MISMATCH"
+            print "%-12s %10.4f %10.3f %8i %8i %8.3f %s"%(name, r['mb_s'], r['link_s'],
+                r['round_trips'], r['syscalls'], r['cpu_s'], status)
+    if saveFile:
+        f = open(saveFile, "w")
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.close()
+    regressions = 0
+    if baseFile:
+        f = open(baseFile)
+        baseline = json.load(f)
+        f.close()
+        regressions = compare(results, baseline, threshold, cpuThreshold)
+        if regressions == 0:
+            print "No regressions against %s"%(baseFile)
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__=='__main__':
+    main(sys.argv)
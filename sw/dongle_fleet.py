@@ -0,0 +1,242 @@
+#! /usr/bin/python
+# -*- coding: ISO-8859-1 -*-
+
+##########################################################################
+# LPC Dongle programming software fleet mode
+#
+# Copyright (C) 2008 Artec Design
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+##########################################################################
+
+#-------------------------------------------------------------------------
+# Project:   LPC Dongle programming software
+# Name:      dongle_fleet.py
+# Purpose:   Erase, write and verify one image on many dongles at the
+#            same time and report the result per port
+#-------------------------------------------------------------------------
+
+import os
+import sys
+import glob
+import getopt
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import dongle
+from dongle import SerialPortException
+from dongle_async import DongleLoop, DongleSession, Return, encode_flash_write
+
+WINDOW = 4*1024*1024     # bytes in the flash and PSRAM window
+
+
+def usage(s):
+    print "Artec USB Dongle fleet programming"
+    print "Usage: ",s," [-v] [-n] -c <port> [-c <port> ...] <file> [<address>|EOF]"
+    print "Options:"
+    print " -c <port>       Port to program, can be given many times. Shell"
+    print "                 patterns are expanded: -c '/dev/ttyUSB*'"
+    print " -n              Don't verify after writing"
+    print " -v              Print each step as it completes"
+    print " <address>       Byte offset in the 4MB window, default 0. EOF puts"
+    print "                 the image at the end of the window"
+    print "Exit status is 1 if any dongle failed"
+
+
+def expand_ports(patterns):
+    """Port names for the -c arguments, patterns expanded, duplicates removed"""
+    ports = []
+    for p in patterns:
+        if p.startswith("emu") or not glob.has_magic(p):
+            names = [p]
+        else:
+            names = glob.glob(p)
+            names.sort()
+            if not names:
+                print "No ports match",p
+        for name in names:
+            if name not in ports or name.startswith("emu"):
+                ports.append(name)
+    return ports
+
+
+class PortReport:
+    """Outcome of one port"""
+    def __init__(self, port):
+        self.port = port
+        self.version = None
+        self.status = "not started"
+        self.times = {}         # step name -> seconds on the link clock
+        self.ok = 0
+
+    def line(self):
+        version = "-"
+        if self.version != None:
+            version = "%02x" % (self.version)
+        times = []
+        for step in ("erase", "write", "verify", "total"):
+            if self.times.has_key(step):
+                times.append("%8.2f" % (self.times[step]))
+            else:
+                times.append("%8s" % ("-"))
+        return "%-24s %4s %s  %s" % (self.port, version, " ".join(times), self.status)
+
+
+def program(session, report, address, image, chunks, verify, verbose):
+    """Erase, write and verify image at word address on one dongle"""
+    clock = session.link
+    start = clock.now()
+    step = start
+    report.status = "handshake"
+    mode = yield session.handshake()
+    report.version = mode.version
+    yield session.lock()
+    try:
+        if mode.region > 3:
+            report.status = "write"
+            yield session.psram_write(address, image)
+        else:
+            report.status = "erase"
+            yield session.erase(address >> 16, (address + len(image)/2 - 1) >> 16)
+            report.times['erase'] = clock.now() - step
+            if verbose:
+                print "%s: erased in %.2fs" % (report.port, report.times['erase'])
+            step = clock.now()
+            report.status = "write"
+            yield session.write_frames(chunks)
+        report.times['write'] = clock.now() - step
+        if verbose:
+            print "%s: written in %.2fs" % (report.port, report.times['write'])
+        if verify:
+            step = clock.now()
+            report.status = "verify"
+            offset = 0
+            while offset < len(image):
+                back = yield session.read_block(address + offset/2, min(65536, (len(image) - offset)/2))
+                if back != image[offset:offset+len(back)]:
+                    i = 0
+                    while back[i] == image[offset+i]:
+                        i += 1
+                    raise SerialPortException('Verify failed at byte 0x%x' % ((address*2) + offset + i))
+                offset += len(back)
+            report.times['verify'] = clock.now() - step
+            if verbose:
+                print "%s: verified in %.2fs" % (report.port, report.times['verify'])
+    except (Exception, SystemExit):
+        # unlock, but report the first failure, the port may be what failed
+        info = sys.exc_info()
+        try:
+            yield session.unlock()
+        except (SerialPortException, SystemExit):
+            pass
+        raise info[0], info[1], info[2]
+    report.status = "unlock"
+    yield session.unlock()
+    report.times['total'] = clock.now() - start
+    report.status = "OK"
+    report.ok = 1
+    yield Return(report)
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], "hvnc:")
+    except getopt.GetoptError, e:
+        print e
+        usage("dongle_fleet.py")
+        sys.exit(2)
+    patterns = []
+    verify = 1
+    verbose = 0
+    for (o, a) in opts:
+        if o == "-h":
+            usage("dongle_fleet.py")
+            sys.exit()
+        elif o == "-c":
+            patterns.append(a)
+        elif o == "-n":
+            verify = 0
+        elif o == "-v":
+            verbose = 1
+    if len(args) < 1 or len(args) > 2 or not patterns:
+        usage("dongle_fleet.py")
+        sys.exit(2)
+    ports = expand_ports(patterns)
+    if not ports:
+        sys.exit(1)
+
+    try:
+        f = open(args[0], "rb")
+        image = f.read()
+        f.close()
+    except IOError:
+        print "IO Error on file open"
+        sys.exit(1)
+    address = 0
+    if len(args) == 2 and args[1].find("EOF") > -1:
+        address = WINDOW - len(image)
+    elif len(args) == 2:
+        address = dongle.DongleMode().convParamStr(args[1])
+    # the dongle writes whole words, an odd start is padded at the front as
+    # dongle.py does, so at EOF the last byte stays at the top of the window
+    if address & 1:
+        image = "\xff" + image
+        address -= 1
+    if len(image) & 1:
+        image = image + "\xff"
+    if address < 0 or address + len(image) > WINDOW:
+        print "Image of %i bytes does not fit at offset 0x%x" % (len(image), address)
+        sys.exit(1)
+    address = address >> 1      # word address
+
+    # encoded once, every session sends the same frames
+    chunks = encode_flash_write(address, image)
+
+    print "Programming %i bytes to %i dongles" % (len(image), len(ports))
+    sys.stdout.flush()
+    loop = DongleLoop()
+    reports = []
+    running = []
+    for port in ports:
+        report = PortReport(port)
+        reports.append(report)
+        try:
+            session = DongleSession(port)
+        except (SerialPortException, SystemExit):
+            report.status = "FAILED: unable to open port"
+            continue
+        task = loop.spawn(program(session, report, address, image, chunks, verify, verbose), port)
+        running.append((task, report))
+    loop.run()
+    for (task, report) in running:
+        try:
+            task.result()
+        except SerialPortException, e:
+            report.status = "FAILED in %s: %s" % (report.status, "".join(e.args))
+        except SystemExit:
+            report.status = "FAILED in %s" % (report.status)
+
+    print "%-24s %4s %8s %8s %8s %8s  %s" % ("port", "ver", "erase s", "write s", "verify s", "total s", "status")
+    failed = 0
+    for report in reports:
+        print report.line()
+        if not report.ok:
+            failed += 1
+    print "%i of %i dongles programmed" % (len(reports) - failed, len(reports))
+    if failed:
+        sys.exit(1)
+
+
+if __name__=='__main__':
+    main(sys.argv)